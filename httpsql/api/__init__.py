@@ -7,21 +7,27 @@
 import psycopg2
 import falcon
 import json
+import base64
+import hashlib
 import os
 import time
-import datetime
+import urllib
+import cStringIO
 import settings
 import db
 import schema
 import query_gen
+import serializer
+import bulk
+import cache
 import auth
+import metrics
+import slowlog
+import notify
 
 from decimal import Decimal
 
-# FEATURE Add update by query
-# FEATURE Add delete by query
 # FEATURE Add distinct values endpoint
-# FEATURE Add mass upsert support
 # FEATURE Add support for ARRAY types
 # FEATURE Add Geo data types
 
@@ -32,23 +38,52 @@ from decimal import Decimal
 def error_serializer(req, exception):
     return ("application/json", exception.to_json())
 
-def json_serializer(obj):
-    if isinstance(obj, datetime.datetime):
-        return obj.isoformat()
-    elif isinstance(obj, datetime.date):
-        return obj.isoformat() 
-    elif isinstance(obj, datetime.time):
-        return obj.isoformat()                       
-    elif isinstance(obj, bool):
-        return obj
-    elif isinstance(obj, Decimal):
-        return float(obj)
-    elif isinstance(obj, buffer):
-        return unicode(obj)
-    raise_internal_error("Type %s not serializable: %s" % (str(type(obj)), obj))
-
 def to_json(obj):
-    return json.dumps(obj, default=json_serializer, sort_keys=True)
+    start = time.time()
+    try:
+        return serializer.dumps(obj)
+    except (TypeError, ValueError, OverflowError), e:
+        raise_internal_error(str(e))
+    finally:
+        metrics.observe(metrics.SERIALIZE_DURATION, time.time() - start)
+
+class JSONStream(object):
+    # Encodes rows into a JSON array one fetched batch at a time
+    def __init__(self, rows, header=None):
+        self.rows = rows
+        self.header = header
+
+    def open(self):
+        if self.header is None:
+            return "["
+        # Compact results start with the column header, known once the first batch is fetched
+        return to_json(self.header())[:-1] + ',"rows":['
+
+    def end(self):
+        return "]" if self.header is None else "]}"
+
+    def __iter__(self):
+        try:
+            chunk_size = int(settings.API_STREAM_ITERSIZE)
+            started = False
+            chunk = []
+            for row in self.rows:
+                chunk.append(to_json(row))
+                if len(chunk) >= chunk_size:
+                    yield (self.open() if not started else ",") + ",".join(chunk)
+                    started = True
+                    chunk = []
+            prefix = self.open() if not started else "," if chunk else ""
+            yield prefix + ",".join(chunk) + self.end()
+        except Exception, e:
+            # Headers are already sent so all we can do is cut the response short
+            log.error("Could not stream rows: %s" % str(e))
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        self.rows.close()
 
 def from_json(obj):
     try:
@@ -56,6 +91,154 @@ def from_json(obj):
     except Exception, e:
         raise_bad_request("Could not decode passed JSON")
 
+###################################################################################################
+# Compact columnar results
+###################################################################################################
+
+COMPACT_CONTENT_TYPE = "application/vnd.httpsql.compact+json"
+
+def get_compact_header(table, columns):
+    tables = schema.current().schema
+    types = tables[table]["columns"] if table in tables else {}
+    return {
+        "columns" : columns,
+        "types"   : [types.get(x) for x in columns]
+    }
+
+def to_compact(table, columns, rows):
+    result = get_compact_header(table, columns)
+    result["rows"] = rows
+    return result
+
+###################################################################################################
+# Streamed bulk inserts
+###################################################################################################
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+CSV_CONTENT_TYPE = "text/csv"
+
+def get_content_type(req):
+    return (req.content_type or "").split(";")[0].strip().lower()
+
+###################################################################################################
+# Batches
+###################################################################################################
+
+# Server details the operations inherit from the batch request, its headers are not passed on
+BATCH_ENV_KEYS = [
+    "wsgi.version", "wsgi.url_scheme", "wsgi.errors", "wsgi.multithread", "wsgi.multiprocess",
+    "wsgi.run_once", "SERVER_NAME", "SERVER_PORT", "SERVER_PROTOCOL", "SCRIPT_NAME", "REMOTE_ADDR"
+]
+
+class BatchRollback(Exception):
+    def __init__(self, results, status):
+        Exception.__init__(self, status)
+        self.results = results
+        self.status = status
+
+def to_utf8(val):
+    return val.encode("utf-8") if isinstance(val, unicode) else str(val)
+
+def get_batch_environ(req, operation):
+    if not isinstance(operation, dict) or not isinstance(operation.get("path"), basestring):
+        raise ValueError("Each operation needs a 'path'")
+    params = operation.get("params") or {}
+    headers = operation.get("headers") or {}
+    if not isinstance(params, dict) or not isinstance(headers, dict):
+        raise ValueError("An operation's 'params' and 'headers' must be objects")
+
+    path, _, query_string = to_utf8(operation["path"]).partition("?")
+    if params:
+        query_string = "&".join([x for x in [query_string, urllib.urlencode([
+            (to_utf8(k), [to_utf8(x) for x in v] if isinstance(v, list) else to_utf8(v))
+            for k, v in params.iteritems()
+        ], True)] if x])
+    body = to_json(operation["body"]) if "body" in operation else ""
+
+    env = {x : req.env[x] for x in BATCH_ENV_KEYS if x in req.env}
+    env.update({
+        "REQUEST_METHOD"   : to_utf8(operation.get("method", "GET")).upper(),
+        "PATH_INFO"        : path,
+        "QUERY_STRING"     : query_string,
+        "CONTENT_TYPE"     : "application/json",
+        "CONTENT_LENGTH"   : str(len(body)),
+        "wsgi.input"       : cStringIO.StringIO(body),
+        auth.BATCH_ENV_KEY : True
+    })
+    for name in headers:
+        env["HTTP_%s" % to_utf8(name).upper().replace("-", "_")] = to_utf8(headers[name])
+    return env
+
+def run_batch_operation(req, operation):
+    # Dispatched through the app itself, so operations behave exactly like their routes
+    try:
+        env = get_batch_environ(req, operation)
+    except ValueError, e:
+        return falcon.HTTP_400, [], to_json({"title" : "Error", "description" : str(e)})
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response["status"] = status
+        response["headers"] = headers
+    body = "".join(app(env, start_response))
+    return response["status"], response["headers"], body
+
+def is_json_content_type(content_type):
+    content_type = content_type.split(";")[0].strip().lower()
+    return content_type == "application/json" or content_type.endswith("+json")
+
+def to_batch_result(status, headers, body):
+    result = to_json({
+        "status"  : int(status.split(" ")[0]),
+        "headers" : {k : v for k, v in headers if k.lower() != "content-length"}
+    })
+    # JSON bodies are spliced in as they are, any other body e.g. /metrics goes in as a string
+    content_type = dict([(k.lower(), v) for k, v in headers]).get("content-type", "")
+    if body and not is_json_content_type(content_type):
+        body = to_json(body.decode("utf-8", "replace"))
+    return result[:-1] + ',"body":' + (body or "null") + "}"
+
+def run_batch(req, operations, stop_on_error=False):
+    results = []
+    for operation in operations:
+        status, headers, body = run_batch_operation(req, operation)
+        results.append(to_batch_result(status, headers, body))
+        if stop_on_error and int(status.split(" ")[0]) >= 400:
+            raise BatchRollback(results, status)
+    return results
+
+###################################################################################################
+# Row count modes
+###################################################################################################
+
+COUNT_EXACT = "exact"
+COUNT_PLANNED = "planned"
+COUNT_ESTIMATED = "estimated"
+COUNT_MODES = [COUNT_EXACT, COUNT_PLANNED, COUNT_ESTIMATED]
+
+###################################################################################################
+# Keyset pagination cursors
+###################################################################################################
+
+CURSOR_START = "start"
+
+def get_cursor_value(value):
+    # As a string so numerics keep their precision, Postgres casts it back
+    return str(value) if isinstance(value, Decimal) else value
+
+def encode_cursor(order, row):
+    token = to_json({
+        "order"  : order,
+        "values" : [get_cursor_value(row[x.replace("-", "")]) for x in order]
+    })
+    return base64.urlsafe_b64encode(token).rstrip("=")
+
+def decode_cursor(token):
+    try:
+        token = str(token)
+        return json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception, e:
+        raise_bad_request("Invalid 'cursor' parameter passed")
+
 ###################################################################################################
 # Fuzzy int match for pagination
 ###################################################################################################
@@ -83,6 +266,17 @@ def raise_internal_error(msg):
     log.error(msg)
     raise falcon.HTTPError(falcon.HTTP_500, "Error", msg)        
 
+def raise_too_large(msg):
+    log.debug(msg)
+    raise falcon.HTTPError(falcon.HTTP_413, "Error", msg)
+
+def raise_unavailable(msg):
+    log.error(msg)
+    raise falcon.HTTPServiceUnavailable("Error", msg, int(settings.DB_CONNECTION_POOL_RETRY_AFTER_SECONDS))
+
+def pool_timeout_handler(ex, req, resp, params):
+    raise_unavailable(str(ex))
+
 ###################################################################################################
 # Request guards
 ###################################################################################################
@@ -92,28 +286,22 @@ def check_db():
         raise_internal_error("Could not connect to database")
 
 def check_schema():
-    interval = 0.5
-    wait = 0
-    while wait < settings.SCHEMA_MAX_WAIT_SECONDS:
-        if schema.SCHEMA != None and schema.FUNCTIONS != None:
-            return
-        time.sleep(interval)
-        wait += interval
-    log.error("Could not retrieve schema")
-    raise_internal_error("Could not retrieve schema")        
+    schema.watch()
+    if schema.pin() is None:
+        raise_unavailable("Could not retrieve schema")
 
 def check_table(table):
-    if table not in schema.SCHEMA:
+    if table not in schema.current().schema:
         raise_not_found()
 
 def check_function(function, args):        
-    if function not in schema.FUNCTIONS:
+    if function not in schema.current().functions:
         raise_not_found()
-    if len(args) != len(schema.FUNCTIONS[function]["parameters"]):
+    if len(args) != len(schema.current().functions[function]["parameters"]):
         raise_bad_request("Incorrect arguments passed")
 
 def check_pk(table, pk):
-    if table not in schema.PKS:
+    if table not in schema.current().pks:
         raise_bad_request("Object doesn't have primary key. Try a query instead.")
 
 def check_pagination(req):
@@ -128,33 +316,223 @@ def check_pagination(req):
         return default
     return get_param("limit", req, settings.API_DEFAULT_COLLECTION_ROW_LIMIT), get_param("offset", req)
 
+def check_count_mode(req):
+    mode = req.params.get("count", COUNT_EXACT)
+    if mode not in COUNT_MODES:
+        raise_bad_request("Invalid 'count' parameter passed")
+    return mode
+
+def get_preferences(req):
+    # Prefer header e.g. "count=exact, return=minimal"
+    preferences = {}
+    for token in (req.get_header("Prefer") or "").split(","):
+        name, _, value = token.strip().partition("=")
+        if name:
+            preferences[name.lower()] = value.strip().strip('"')
+    return preferences
+
+def check_pk_lookup_limit(table, req, limit):
+    # Fetching rows by a list of primary keys returns all of them unless a limit is passed
+    if "limit" in req.params or table not in schema.current().pks:
+        return limit
+    pks = req.params.get("%s__in" % schema.current().pks[table])
+    if isinstance(pks, list) and len(pks) > int(limit or 0):
+        return len(pks)
+    return limit
+
+RETURN_MINIMAL = "minimal"
+RETURN_REPRESENTATION = "representation"
+
+def check_return(req, resp, default):
+    # True when the written row should be sent back
+    preference = get_preferences(req).get("return")
+    if preference in [RETURN_MINIMAL, RETURN_REPRESENTATION]:
+        resp.set_header("Preference-Applied", "return=%s" % preference)
+        return preference == RETURN_REPRESENTATION
+    return default == RETURN_REPRESENTATION
+
+# Clients are pinned to the primary for a while after writing, so they read their own writes
+PRIMARY_COOKIE = "httpsql_primary"
+
+def use_replica(req):
+    if not db.DB_REPLICAS or req.method not in ["GET", "HEAD"] or PRIMARY_COOKIE in req.cookies:
+        return False
+    # Replica lag is checked on the listener thread
+    notify.start()
+    return True
+
+if db.DB_ONLINE and db.DB_REPLICAS:
+    notify.schedule(settings.DB_REPLICA_LAG_CHECK_SECONDS, db.check_replica_lag)
+
+# Route templates by resource, for labeling metrics
+ROUTE_TEMPLATES = {}
+
+def get_route_labels(req, resource):
+    route = ROUTE_TEMPLATES.get(id(resource), "")
+    collection = ""
+    if "{object_name}" in route:
+        # Only known names, so bogus paths can't grow the label set
+        name = req.path.strip("/").split("/")[1]
+        snapshot = schema.current()
+        if snapshot and (name in snapshot.schema or name in snapshot.functions):
+            collection = name
+    return (("route", route), ("collection", collection), ("method", req.method))
+
+class MetricsMiddleware(object):
+    def process_request(self, req, resp):
+        if req.env.get(auth.BATCH_ENV_KEY):
+            return
+        req.context["metrics_start"] = time.time()
+        metrics.start_request()
+        metrics.start()
+
+    def process_response(self, req, resp, resource):
+        start = req.context.get("metrics_start")
+        if start is None:
+            return
+        labels = get_route_labels(req, resource)
+        metrics.observe(metrics.REQUEST_DURATION, time.time() - start, labels)
+        metrics.inc(metrics.REQUESTS, labels + (("status", resp.status[:3]),))
+        if resp.body:
+            metrics.inc(metrics.RESPONSE_BYTES, labels, len(resp.body))
+        metrics.observe(metrics.RESPONSE_ROWS, metrics.get_request_rows(), labels)
+
+class ReadYourWritesMiddleware(object):
+    def process_response(self, req, resp, resource):
+        if not db.DB_REPLICAS or req.env.get(auth.BATCH_ENV_KEY) or req.method in ["GET", "HEAD", "OPTIONS"]:
+            return
+        if int(resp.status[:3]) < 400 and int(settings.API_READ_YOUR_WRITES_SECONDS):
+            resp.set_cookie(PRIMARY_COOKIE, "1",
+                            max_age=int(settings.API_READ_YOUR_WRITES_SECONDS),
+                            path="/",
+                            secure=req.protocol == "https")
+
+def check_stream(req):
+    stream = req.get_param_as_bool("stream")
+    if stream and req.env.get(auth.BATCH_ENV_KEY):
+        raise_bad_request("The 'stream' parameter isn't supported in batches")
+    if stream and "cursor" in req.params:
+        raise_bad_request("The 'stream' and 'cursor' parameters can't be combined")
+    return stream
+
+def check_format(req):
+    if "format" in req.params:
+        format = req.params["format"]
+        if format not in ["json", "compact"]:
+            raise_bad_request("Invalid 'format' parameter passed")
+        return format == "compact"
+    return COMPACT_CONTENT_TYPE in (req.get_header("Accept") or "")
+
+def set_format(resp, compact):
+    headers = {
+        "Vary"         : "Accept",
+        "Content-Type" : COMPACT_CONTENT_TYPE if compact else "application/json"
+    }
+    resp.set_headers(headers)
+    return headers
+
 def check_order_by(table, req):
     if "order_by" in req.params:
         order_by = req.params["order_by"]
         if not isinstance(order_by, list):
             order_by = [order_by]
-        return [x for x in order_by if x.replace("-", "") in schema.SCHEMA[table]["columns"]]
+        return [x for x in order_by if x.replace("-", "") in schema.current().schema[table]["columns"]]
     return None
 
+def check_cursor(table, req, order_by):
+    if "cursor" not in req.params:
+        return order_by, None
+    check_pk(table, None)
+    if "offset" in req.params:
+        raise_bad_request("The 'cursor' and 'offset' parameters can't be combined")
+
+    # The primary key breaks ties so every row has a unique position
+    pk = schema.current().pks[table]
+    order_by = list(order_by or [])
+    if pk not in [x.replace("-", "") for x in order_by]:
+        order_by.append("-%s" % pk if order_by and order_by[0].find("-") == 0 else pk)
+
+    token = req.params["cursor"]
+    if token == CURSOR_START:
+        return order_by, []
+    cursor = decode_cursor(token)
+    if not isinstance(cursor, dict) or cursor.get("order") != order_by \
+            or len(cursor.get("values") or []) != len(order_by):
+        raise_bad_request("The 'cursor' parameter doesn't match the 'order_by' parameter")
+    return order_by, cursor["values"]
+
+def check_copy_size(req):
+    # Cooperative workers read streamed bodies into memory before the COPY, so they are bounded
+    limit = int(settings.DB_COOPERATIVE_COPY_MAX_BYTES)
+    if settings.DB_COOPERATIVE and req.content_length > limit:
+        raise_too_large("Streamed bodies are limited to %d bytes" % limit)
+
+def get_copy_stream(req):
+    limit = int(settings.DB_COOPERATIVE_COPY_MAX_BYTES) if settings.DB_COOPERATIVE else None
+    return bulk.BoundedReader(req.stream, req.content_length, limit)
+
+def get_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+def check_etag(req, resp, etag):
+    # True when the client's copy is still current i.e. nothing needs to be sent
+    resp.etag = etag
+    if_none_match = req.get_header("If-None-Match")
+    if if_none_match:
+        tags = [x.strip().replace("W/", "", 1) for x in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            resp.body = None
+            resp.status = falcon.HTTP_304
+            return True
+    return False
+
+def serve_cached(key, resp):
+    cached = cache.get_response(key)
+    if cached is None:
+        return False
+    body, headers = cached
+    for name in headers:
+        resp.set_header(name, headers[name])
+    resp.body = body
+    resp.status = falcon.HTTP_200
+    return True
+
 ###################################################################################################
 # Data manipulation
 ###################################################################################################
 
-def get_function_rows(conn, function, args, limit=None, offset=None, order=None):
+def get_function_rows(conn, function, args, limit=None, offset=None, order=None, compact=False):
     try:
         with conn.cursor() as c:
             query, _args = query_gen.get_function_query(function, args, limit, offset, order)
-            c.execute(query, _args)
+            db.execute(c, query, _args, explain=schema.current().functions[function]["read_only"])
+            if compact:
+                columns, rows = db.compactfetchall(c)
+                return to_compact(schema.current().functions[function]["type"], columns, rows)
             return db.dictfetchall(c)
     except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
         raise_bad_request(str(e))
     except Exception, e:
         raise_internal_error(str(e))        
 
+def stream_function_rows(function, args, limit=None, offset=None, order=None, compact=False, replica=False):
+    try:
+        query, _args = query_gen.get_function_query(function, args, limit, offset, order)
+        log.debug(query)
+        rows = db.stream_rows(query, _args, compact, replica)
+        header = (lambda: get_compact_header(schema.current().functions[function]["type"], rows.columns())) if compact else None
+        return JSONStream(rows, header)
+    except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
+        raise_bad_request(str(e))
+    except db.PoolTimeoutError:
+        raise
+    except Exception, e:
+        raise_internal_error(str(e))        
+
 def get_table_rows(conn, table, limit=None, offset=None, order=None):
     try:
         with conn.cursor() as c:
-            c.execute(query_gen.get_table_rows_query(table, limit, offset))
+            db.execute(c, query_gen.get_table_rows_query(table, limit, offset), explain=True)
             return db.dictfetchall(c)
     except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
         raise_bad_request(str(e))
@@ -164,7 +542,7 @@ def get_table_rows(conn, table, limit=None, offset=None, order=None):
 def get_table_row(conn, table, pk):
     try:
         with conn.cursor() as c:
-            c.execute(query_gen.get_table_row_query(schema.PKS, table, pk), [pk])
+            db.execute(c, query_gen.get_table_row_query(schema.current().pks, table, pk), [pk], prepare=True, explain=True)
             rows = db.dictfetchall(c)
             if len(rows) > 0:
                 return rows
@@ -174,30 +552,29 @@ def get_table_row(conn, table, pk):
     except Exception, e:
         raise_internal_error(str(e))        
 
-def delete_table_row(conn, table, pk):
+# Writes return the affected rows from RETURNING for a representation, only their count otherwise
+
+def delete_table_row(conn, table, pk, representation=False):
     try:
-        query = query_gen.delete_table_row_query(schema.PKS, table, pk)
+        query = query_gen.delete_table_row_query(schema.current().pks, table, pk, representation)
         log.debug(query)
         with conn.cursor() as c:
-            c.execute(query, [pk])
+            db.execute(c, query, [pk], prepare=True)
+            return db.dictfetchall(c) if representation else c.rowcount
     except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
         raise_bad_request(str(e))
     except Exception, e:
         raise_internal_error(str(e))        
 
-def insert_table_row(conn, table, obj):
+def insert_table_row(conn, table, obj, representation=False):
     try:
-        query = query_gen.insert_table_row_query(table, obj)
+        query = query_gen.insert_table_row_query(table, obj, representation)
         params = [obj[x] for x in query_gen.typeify(obj, table)]
         log.debug(query)
         log.debug(params)        
         with conn.cursor() as c:
-            c.execute(query, params)
-            try:
-                val = c.fetchone()[0]
-                return val
-            except:
-                return None
+            db.execute(c, query, params, prepare=True)
+            return db.dictfetchall(c) if representation else c.rowcount
     except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
         raise_bad_request(str(e))
     except Exception, e:
@@ -207,97 +584,288 @@ def insert_table_rows(conn, table, objs):
     try:
         copy_stmt, insert_buffer = query_gen.insert_table_rows_query(table, objs)
         log.debug(copy_stmt)
-        log.debug(insert_buffer)
         with conn.cursor() as c:
-            c.copy_expert(copy_stmt, insert_buffer)
+            db.copy_expert(c, copy_stmt, insert_buffer)
             return []
     except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
         raise_bad_request(str(e))
     except Exception, e:
         raise_internal_error(str(e))        
 
-def update_table_row(conn, table, pk, obj):
+def get_copy_source(table, body, content_type):
+    if content_type == CSV_CONTENT_TYPE:
+        return query_gen.get_csv_copy_source(table, body)
+    elif content_type == NDJSON_CONTENT_TYPE:
+        return query_gen.get_ndjson_copy_source(table, body)
+    return query_gen.get_rows_copy_source(table, body)
+
+def copy_table_rows(conn, table, stream, content_type):
+    reader = None
+    try:
+        columns, reader, format = get_copy_source(table, stream, content_type)
+        if columns is None:
+            return 0
+        copy_stmt = bulk.get_copy_query(table, columns, format)
+        log.debug(copy_stmt)
+        with conn.cursor() as c:
+            db.copy_expert(c, copy_stmt, reader, bulk.COPY_BUFFER_SIZE)
+            return c.rowcount
+    except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
+        raise_bad_request(str(e))
+    except bulk.BodyTooLargeError, e:
+        raise_too_large(str(e))
+    except (psycopg2.extensions.QueryCanceledError, ValueError), e:
+        # Errors while COPY reads the body cancel it, or raise as is when it was read up front
+        if getattr(reader, "error", None):
+            raise_bad_request(reader.error)
+        raise_internal_error(str(e))
+    except Exception, e:
+        raise_internal_error(str(e))        
+
+def upsert_table_rows(conn, table, body, content_type):
+    reader = None
     try:
-        query = query_gen.update_table_row_query(schema.PKS, table, obj)
+        columns, reader, format = get_copy_source(table, body, content_type)
+        if columns is None:
+            return {"inserted" : 0, "updated" : 0}
+        create_stmt, copy_stmt, upsert_stmt, drop_stmt = query_gen.upsert_table_rows_queries(schema.current().pks, table, columns, format)
+        log.debug(upsert_stmt)
+        with db.transaction(conn):
+            with conn.cursor() as c:
+                db.execute(c, create_stmt)
+                db.copy_expert(c, copy_stmt, reader, bulk.COPY_BUFFER_SIZE)
+                db.execute(c, upsert_stmt)
+                counts = db.dictfetchall(c)[0]
+                db.execute(c, drop_stmt)
+                return counts
+    except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
+        raise_bad_request(str(e))
+    except bulk.BodyTooLargeError, e:
+        raise_too_large(str(e))
+    except (psycopg2.extensions.QueryCanceledError, ValueError), e:
+        if getattr(reader, "error", None):
+            raise_bad_request(reader.error)
+        raise_internal_error(str(e))
+    except psycopg2.ProgrammingError, e:
+        # The same primary key passed twice
+        if e.pgcode == "21000":
+            raise_bad_request(str(e))
+        raise_internal_error(str(e))
+    except Exception, e:
+        raise_internal_error(str(e))        
+
+def update_table_row(conn, table, pk, obj, representation=True):
+    try:
+        query = query_gen.update_table_row_query(schema.current().pks, table, obj, representation)
         params = [obj[x] for x in query_gen.typeify(obj, table)] + [pk]
         log.debug(query)
         log.debug(params)        
         with conn.cursor() as c:
-            c.execute(query, params)
-            result = c.fetchone()
-            if len(result) > 0:
-                return {schema.PKS[table] : result[0]}
+            db.execute(c, query, params, prepare=True)
+            return db.dictfetchall(c) if representation else c.rowcount
     except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
         raise_bad_request(str(e))
     except Exception, e:
         raise_internal_error(str(e))
 
-def get_table_query_row_count(conn, table, filters, limit=None, offset=None, order=None):
+def write_table_query_rows(conn, table, filters, obj=None, return_pks=False):
+    # Update the matching rows when obj is passed, delete them otherwise
     try:
-        query, params = query_gen.get_filtered_rows_query(table, filters, limit, offset, order)
+        returning = schema.current().pks[table] if return_pks else None
+        if obj is not None:
+            query, params = query_gen.get_filtered_update_query(table, filters, obj, returning)
+        else:
+            query, params = query_gen.get_filtered_delete_query(table, filters, returning)
         log.debug(query)
         log.debug(params)
         with conn.cursor() as c:
-            c.execute(query_gen.get_row_count_query(query), params)
-            return db.dictfetchall(c)[0]
+            db.execute(c, query, params, prepare=True)
+            result = {"count" : c.rowcount}
+            if return_pks:
+                result["pks"] = [x[0] for x in c.fetchall()]
+            return result
     except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
         raise_bad_request(str(e))
     except Exception, e:
         raise_internal_error(str(e))        
 
-def get_table_query_rows(conn, table, filters, limit=None, offset=None, order=None):
+def get_table_query_row_count(conn, table, filters, limit=None, offset=None, order=None, mode=COUNT_EXACT):
     try:
         query, params = query_gen.get_filtered_rows_query(table, filters, limit, offset, order)
         log.debug(query)
         log.debug(params)
         with conn.cursor() as c:
-            c.execute(query, params)
-            return db.dictfetchall(c)
+            if mode == COUNT_ESTIMATED:
+                # Table statistics only know about unfiltered counts
+                if not query_gen.get_filter_signature(table, filters):
+                    db.execute(c, query_gen.get_estimated_row_count_query(), [settings.DB_SCHEMA, table], prepare=True)
+                    row = c.fetchone()
+                    if row and row[0] >= 0:
+                        return {"count" : int(row[0])}, COUNT_ESTIMATED
+                mode = COUNT_PLANNED
+            if mode == COUNT_PLANNED:
+                db.execute(c, query_gen.get_planned_row_count_query(query), params)
+                plan = c.fetchone()[0]
+                if isinstance(plan, basestring):
+                    plan = json.loads(plan)
+                return {"count" : int(plan[0]["Plan"]["Plan Rows"])}, COUNT_PLANNED
+            key = cache.count_key(table, query, params)
+            count = cache.get_count(key)
+            if count is None:
+                db.execute(c, query_gen.get_row_count_query(query), params, prepare=True, explain=True)
+                count = db.dictfetchall(c)[0]
+                cache.put_count(key, conn, count)
+            return count, COUNT_EXACT
+    except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
+        raise_bad_request(str(e))
+    except Exception, e:
+        raise_internal_error(str(e))        
+
+def get_table_query_rows(conn, table, filters, limit=None, offset=None, order=None, after=None, compact=False, total=False):
+    try:
+        query, params = query_gen.get_filtered_rows_query(table, filters, limit, offset, order, after, total)
+        log.debug(query)
+        log.debug(params)
+        with conn.cursor() as c:
+            db.execute(c, query, params, prepare=True, explain=True)
+            # The total comes back as an extra last column of every row
+            has_total = c.description is not None and c.description[-1][0] == query_gen.TOTAL_COLUMN
+            count = None
+            if compact:
+                columns, rows = db.compactfetchall(c)
+                if has_total:
+                    columns.pop()
+                    count = rows[0][-1] if rows else None
+                    rows = [x[:-1] for x in rows]
+                result = to_compact(table, columns, rows)
+            else:
+                result = db.dictfetchall(c)
+                if has_total:
+                    for row in result:
+                        count = row.pop(query_gen.TOTAL_COLUMN)
+            if has_total and count is None and not offset:
+                count = 0
+            return result, count
     except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
         raise_bad_request(str(e))
     except Exception, e:
         raise_internal_error(str(e))        
 
+def stream_table_query_rows(table, filters, limit=None, offset=None, order=None, compact=False, replica=False):
+    try:
+        query, params = query_gen.get_filtered_rows_query(table, filters, limit, offset, order)
+        log.debug(query)
+        log.debug(params)
+        rows = db.stream_rows(query, params, compact, replica)
+        header = (lambda: get_compact_header(table, rows.columns())) if compact else None
+        return JSONStream(rows, header)
+    except (query_gen.QueryGenError, psycopg2.DataError, psycopg2.IntegrityError), e:
+        raise_bad_request(str(e))
+    except db.PoolTimeoutError:
+        raise
+    except Exception, e:
+        raise_internal_error(str(e))        
+
 ###################################################################################################
 # API Resources
 ###################################################################################################
 
+def serve_schema_document(req, resp, name):
+    body, etag = schema.current().documents[name]
+    if check_etag(req, resp, etag):
+        return
+    resp.body = body
+    resp.status = falcon.HTTP_200
+
 class SchemaResource(object):
     def on_get(self, req, resp):
         check_db()
         check_schema()    
+        serve_schema_document(req, resp, "all")
+
+class StatsResource(object):
+    def on_get(self, req, resp):
+        check_db()
         resp.body = to_json({
-            "collection" : schema.SCHEMA,
-            "function"   : schema.FUNCTIONS
+            "pool"     : db.DB_POOL.stats(),
+            "replicas" : [x.stats() for x in db.DB_REPLICAS]
         })
         resp.status = falcon.HTTP_200
 
+class SlowQueriesResource(object):
+    def on_get(self, req, resp):
+        limit = req.get_param_as_int("limit", min=1) or 10
+        resp.body = to_json(slowlog.get_top(limit))
+        resp.status = falcon.HTTP_200
+
+class BatchResource(object):
+    def on_post(self, req, resp):
+        check_db()
+        check_schema()
+        if req.env.get(auth.BATCH_ENV_KEY):
+            raise_bad_request("Batches can't be nested")
+        batch = from_json(req.stream.read())
+        transaction = False
+        if isinstance(batch, dict):
+            transaction = batch.get("transaction") is True
+            batch = batch.get("operations")
+        if not isinstance(batch, list):
+            raise_bad_request("Pass a list of operations")
+        if len(batch) > int(settings.API_BATCH_MAX_OPERATIONS):
+            raise_bad_request("Batches are limited to %s operations" % settings.API_BATCH_MAX_OPERATIONS)
+        status = falcon.HTTP_200
+        with db.shared_conn() as conn:
+            if transaction:
+                # The first failed operation rolls back the batch and ends it
+                try:
+                    with db.transaction(conn):
+                        results = run_batch(req, batch, True)
+                except BatchRollback, e:
+                    results, status = e.results, e.status
+            else:
+                results = run_batch(req, batch)
+        resp.body = "[%s]" % ",".join(results)
+        resp.status = status
+
+class MetricsResource(object):
+    def on_get(self, req, resp):
+        resp.content_type = metrics.CONTENT_TYPE
+        resp.body = metrics.expose()
+        resp.status = falcon.HTTP_200
+
 class FunctionSchemaResource(object):
     def on_get(self, req, resp):
         check_db()
         check_schema()    
-        resp.body = to_json(schema.FUNCTIONS)
-        resp.status = falcon.HTTP_200
+        serve_schema_document(req, resp, "function")
 
 class CollectionSchemaResource(object):
     def on_get(self, req, resp):
         check_db()
         check_schema()    
-        resp.body = to_json(schema.SCHEMA)
-        resp.status = falcon.HTTP_200
+        serve_schema_document(req, resp, "collection")
 
 class FunctionResource(object):
     def handle(self, req, resp, object_name):
         check_db()
         check_schema()
+        functions = schema.current().functions
         args = {x:req.params[x] 
                 for x in req.params 
-                if object_name in schema.FUNCTIONS and x in schema.FUNCTIONS[object_name]["parameters"]}
+                if object_name in functions and x in functions[object_name]["parameters"]}
         check_function(object_name, args)
         limit, offset = check_pagination(req)
-        with db.conn() as conn:
-            order_by = check_order_by(schema.SCHEMA[schema.FUNCTIONS[object_name]["type"]], req)
-            resp.body = to_json(get_function_rows(conn, object_name, args, limit, offset, order_by))
+        compact = check_format(req)
+        set_format(resp, compact)
+        replica = use_replica(req) and functions[object_name]["read_only"]
+        if check_stream(req):
+            order_by = check_order_by(functions[object_name]["type"], req)
+            resp.stream = stream_function_rows(object_name, args, limit, offset, order_by, compact, replica)
+            resp.status = falcon.HTTP_200
+            return
+        with db.conn(replica) as conn:
+            order_by = check_order_by(functions[object_name]["type"], req)
+            resp.body = to_json(get_function_rows(conn, object_name, args, limit, offset, order_by, compact))
             resp.status = falcon.HTTP_200
 
     def on_get(self, req, resp, object_name):
@@ -311,8 +879,11 @@ class CountResource(object):
         check_db()
         check_schema()
         check_table(object_name)
-        with db.conn() as conn:
-            resp.body = to_json(get_table_query_row_count(conn, object_name, req.params))
+        mode = check_count_mode(req)
+        with db.conn(use_replica(req)) as conn:
+            count, mode = get_table_query_row_count(conn, object_name, req.params, mode=mode)
+            resp.set_header("X-Count-Mode", mode)
+            resp.body = to_json(count)
             resp.status = falcon.HTTP_200
 
 class MultiResource(object):
@@ -321,74 +892,188 @@ class MultiResource(object):
         check_schema()
         check_table(object_name)
         limit, offset = check_pagination(req)
-        with db.conn() as conn:
+        limit = check_pk_lookup_limit(object_name, req, limit)
+        compact = check_format(req)
+        headers = set_format(resp, compact)
+        if check_stream(req):
             order_by = check_order_by(object_name, req)
-            resp.body = to_json(get_table_query_rows(conn, object_name, req.params, limit, offset, order_by))
+            resp.stream = stream_table_query_rows(object_name, req.params, limit, offset, order_by, compact, use_replica(req))
+            resp.status = falcon.HTTP_200
+            return
+        total = get_preferences(req).get("count") == COUNT_EXACT
+        headers["Vary"] = "Accept, Prefer"
+        key = cache.response_key(object_name, req, (compact, total))
+        if serve_cached(key, resp):
+            return
+        with db.conn(use_replica(req)) as conn:
+            order_by, after = check_cursor(object_name, req, check_order_by(object_name, req))
+            total = total and after is None
+            result, count = get_table_query_rows(conn, object_name, req.params, limit, offset, order_by, after, compact, total)
+            rows = result["rows"] if compact else result
+            if after is not None and limit and len(rows) == int(limit):
+                last = dict(zip(result["columns"], rows[-1])) if compact else rows[-1]
+                headers["X-Next-Cursor"] = encode_cursor(order_by, last)
+            if total:
+                # Only a page past the last row leaves the total unknown
+                if count is None:
+                    count = get_table_query_row_count(conn, object_name, req.params)[0]["count"]
+                start = offset or 0
+                headers["Content-Range"] = "%d-%d/%d" % (start, start + len(rows) - 1, count) if rows else "*/%d" % count
+                headers["Preference-Applied"] = "count=exact"
+            resp.set_headers(headers)
+            resp.body = to_json(result)
             resp.status = falcon.HTTP_200    
+            cache.put_response(key, conn, resp.body, headers)
 
     def on_put(self, req, resp, object_name):
         check_db()
         check_schema()
         check_table(object_name)
+        content_type = get_content_type(req)
+        streamed = content_type in [NDJSON_CONTENT_TYPE, CSV_CONTENT_TYPE]
+        if streamed:
+            check_copy_size(req)
+        if req.get_param_as_bool("upsert"):
+            check_pk(object_name, None)
+            with db.conn() as conn:
+                if streamed:
+                    body = get_copy_stream(req)
+                else:
+                    body = from_json(req.stream.read())
+                    body = [body] if isinstance(body, dict) else body
+                    if not isinstance(body, list):
+                        raise_bad_request("Pass an object or a list of objects")
+                resp.body = to_json(upsert_table_rows(conn, object_name, body, content_type))
+                cache.invalidate(conn, object_name)
+                resp.status = falcon.HTTP_200
+            return
+        if streamed:
+            # Rows go to COPY as they arrive instead of loading the body first
+            with db.conn() as conn:
+                copy_table_rows(conn, object_name, get_copy_stream(req), content_type)
+                cache.invalidate(conn, object_name)
+                resp.status = falcon.HTTP_204
+            return
         with db.conn() as conn:
             objs = from_json(req.stream.read())
             if not isinstance(objs, list):
-                t_resp = to_json(insert_table_row(conn, object_name, objs))
-                log.debug(t_resp)
-                resp.body = t_resp
-
+                representation = check_return(req, resp, RETURN_MINIMAL)
+                rows = insert_table_row(conn, object_name, objs, representation)
+                cache.invalidate(conn, object_name)
+                if representation:
+                    resp.body = to_json(rows)
+                    resp.status = falcon.HTTP_201
+                    return
             else:
-                resp.body = to_json(insert_table_rows(conn, object_name, objs))
+                insert_table_rows(conn, object_name, objs)
+                cache.invalidate(conn, object_name)
             resp.status = falcon.HTTP_204
 
+    def on_post(self, req, resp, object_name):
+        check_db()
+        check_schema()
+        check_table(object_name)
+        return_pks = req.get_param_as_bool("return_pks")
+        if return_pks:
+            check_pk(object_name, None)
+        with db.conn() as conn:
+            obj = from_json(req.stream.read())
+            if not isinstance(obj, dict):
+                raise_bad_request("Pass an object of the fields to update")
+            resp.body = to_json(write_table_query_rows(conn, object_name, req.params, obj, return_pks))
+            cache.invalidate(conn, object_name)
+            resp.status = falcon.HTTP_200
+
+    def on_delete(self, req, resp, object_name):
+        check_db()
+        check_schema()
+        check_table(object_name)
+        return_pks = req.get_param_as_bool("return_pks")
+        if return_pks:
+            check_pk(object_name, None)
+        with db.conn() as conn:
+            resp.body = to_json(write_table_query_rows(conn, object_name, req.params, None, return_pks))
+            cache.invalidate(conn, object_name)
+            resp.status = falcon.HTTP_200
+
 class SingleResource(object):
     def on_get(self, req, resp, object_name, pk):
         check_db()
         check_schema()
-        with db.conn() as conn:
-            check_table(object_name)
-            check_pk(object_name, pk)
-            row = get_table_row(conn, object_name, pk)
-            if row:
-                resp.body = to_json(row)
-                resp.status = falcon.HTTP_200
-            else:
-                raise_not_found()
+        check_table(object_name)
+        check_pk(object_name, pk)
+        key = cache.response_key(object_name, req)
+        cached = cache.get_response(key)
+        if cached:
+            body, headers = cached
+        else:
+            with db.conn(use_replica(req)) as conn:
+                row = get_table_row(conn, object_name, pk)
+                if not row:
+                    raise_not_found()
+            body = to_json(row)
+            headers = {"ETag" : get_etag(body)}
+            cache.put_response(key, conn, body, headers)
+        if check_etag(req, resp, headers["ETag"]):
+            return
+        resp.body = body
+        resp.status = falcon.HTTP_200
 
     def on_post(self, req, resp, object_name, pk):
         check_db()
         check_schema()
         check_table(object_name)
         check_pk(object_name, pk)
+        representation = check_return(req, resp, RETURN_REPRESENTATION)
         with db.conn() as conn:
             obj = from_json(req.stream.read())
-            update_table_row(conn, object_name, pk, obj)
-            row = get_table_row(conn, object_name, pk)
-            if row:
-                resp.body = to_json(row)
+            result = update_table_row(conn, object_name, pk, obj, representation)
+            cache.invalidate(conn, object_name)
+            if not result:
+                raise_not_found()
+            if representation:
+                resp.body = to_json(result)
                 resp.status = falcon.HTTP_200
             else:
-                raise_not_found()
+                resp.status = falcon.HTTP_204
 
     def on_delete(self, req, resp, object_name, pk):
         check_db()
         check_schema()
         check_table(object_name)
         check_pk(object_name, pk)
+        representation = check_return(req, resp, RETURN_MINIMAL)
         with db.conn() as conn:
-            delete_table_row(conn, object_name, pk)
-            resp.status = falcon.HTTP_204
+            result = delete_table_row(conn, object_name, pk, representation)
+            cache.invalidate(conn, object_name)
+            if representation:
+                if not result:
+                    raise_not_found()
+                resp.body = to_json(result)
+                resp.status = falcon.HTTP_200
+            else:
+                resp.status = falcon.HTTP_204
 
 ###################################################################################################
 # Initialize the API
 ###################################################################################################
 
-app = falcon.API(middleware=[auth.BasicAuthMiddleware(), auth.TokenAuthMiddleware()])
+app = falcon.API(middleware=[MetricsMiddleware(), auth.BasicAuthMiddleware(), auth.TokenAuthMiddleware(), ReadYourWritesMiddleware()])
 app.set_error_serializer(error_serializer)
-app.add_route('/',                               SchemaResource())
-app.add_route('/function',                       FunctionSchemaResource())
-app.add_route('/collection',                     CollectionSchemaResource())
-app.add_route('/function/{object_name}',         FunctionResource())
-app.add_route('/collection/{object_name}',       MultiResource())
-app.add_route('/collection/{object_name}/count', CountResource())
-app.add_route('/collection/{object_name}/{pk}',  SingleResource())
\ No newline at end of file
+app.add_error_handler(db.PoolTimeoutError, pool_timeout_handler)
+
+for route, resource in [
+    ('/',                               SchemaResource()),
+    ('/stats',                          StatsResource()),
+    ('/stats/slow_queries',             SlowQueriesResource()),
+    ('/metrics',                        MetricsResource()),
+    ('/batch',                          BatchResource()),
+    ('/function',                       FunctionSchemaResource()),
+    ('/collection',                     CollectionSchemaResource()),
+    ('/function/{object_name}',         FunctionResource()),
+    ('/collection/{object_name}',       MultiResource()),
+    ('/collection/{object_name}/count', CountResource()),
+    ('/collection/{object_name}/{pk}',  SingleResource())
+]:
+    ROUTE_TEMPLATES[id(resource)] = route
+    app.add_route(route, resource)
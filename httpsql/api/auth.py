@@ -8,8 +8,13 @@ import falcon
 import settings
 
 
+# Batch operations are dispatched in process after the batch request itself was authorized
+BATCH_ENV_KEY = "httpsql.batch"
+
 class BasicAuthMiddleware(object):
     def process_request(self, req, resp):
+        if req.env.get(BATCH_ENV_KEY):
+            return
         if settings.BASIC_AUTH_USER and settings.BASIC_AUTH_PASSWORD:
             authorization = req.get_header("Authorization")
             if not authorization:
@@ -26,6 +31,8 @@ class BasicAuthMiddleware(object):
 
 class TokenAuthMiddleware(object):
     def process_request(self, req, resp):
+        if req.env.get(BATCH_ENV_KEY):
+            return
         if settings.TOKEN_AUTH:
             token = req.params.get("token", "")
             if not token or token != settings.TOKEN_AUTH:
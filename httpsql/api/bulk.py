@@ -0,0 +1,191 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+# Encoders for COPY's text format, https://www.postgresql.org/docs/current/static/sql-copy.html
+
+NULL = "\\N"
+
+HSTORE_TYPE = "hstore"
+ARRAY_TYPE = "ARRAY"
+BYTEA_TYPE = "bytea"
+
+def escape(val):
+    # Most values have nothing to escape, checking first is cheaper than four replaces
+    if "\\" in val or "\t" in val or "\n" in val or "\r" in val:
+        return val.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    return val
+
+def to_str(val):
+    if isinstance(val, unicode):
+        return val.encode("utf-8")
+    return val if isinstance(val, str) else unicode(val).encode("utf-8")
+
+# Raw UTF-8 rather than \u escapes, which jsonb rejects on non UTF-8 databases
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+def to_json(val):
+    return to_str(JSON_ENCODER.encode(val))
+
+def to_text(val):
+    # Value in the type's input syntax, before COPY escaping
+    return TEXT_CONVERTERS.get(type(val), to_str)(val)
+
+def quote(val):
+    # Double quoted element of an hstore or array literal
+    return '"%s"' % to_text(val).replace("\\", "\\\\").replace('"', '\\"')
+
+def to_hstore(val):
+    return ",".join([
+        "%s=>%s" % (quote(k), "NULL" if val[k] is None else quote(val[k]))
+        for k in val
+    ])
+
+def to_array(val):
+    return "{%s}" % ",".join([
+        "NULL" if x is None else to_array(x) if isinstance(x, list) else quote(x)
+        for x in val
+    ])
+
+def to_bytea(val):
+    return "\\x" + str(val).encode("hex")
+
+TEXT_CONVERTERS = {
+    str     : str,
+    unicode : to_str,
+    bool    : lambda val: "t" if val else "f",
+    int     : str,
+    long    : str,
+    float   : repr,
+    dict    : to_json,
+    list    : to_json
+}
+
+# Encoders by the value's type, numbers and booleans never need escaping
+ENCODERS = {
+    type(None) : lambda val: NULL,
+    str        : escape,
+    unicode    : lambda val: escape(val.encode("utf-8")),
+    bool       : TEXT_CONVERTERS[bool],
+    int        : str,
+    long       : str,
+    float      : repr,
+    dict       : lambda val: escape(to_json(val)),
+    list       : lambda val: escape(to_json(val))
+}
+
+# Column types whose literals differ from the value's default text
+TYPE_ENCODERS = {
+    HSTORE_TYPE : {dict : lambda val: escape(to_hstore(val))},
+    ARRAY_TYPE  : {list : lambda val: escape(to_array(val))},
+    BYTEA_TYPE  : {buffer : to_bytea, bytearray : to_bytea}
+}
+
+def encode_value(val):
+    return escape(to_str(val))
+
+def get_value_encoders(ctype):
+    encoders = dict(ENCODERS)
+    encoders.update(TYPE_ENCODERS.get(ctype, {}))
+    return encoders
+
+COPY_BUFFER_SIZE = 65536
+
+def compile_row_encoder(columns, types):
+    # Encoder lookups per column picked up front, so a row is one pass over its values
+    encoders = [(column, get_value_encoders(types[column]).get) for column in columns]
+
+    def encode_row(row):
+        line = []
+        for column, get_encoder in encoders:
+            val = row[column]
+            line.append(get_encoder(type(val), encode_value)(val))
+        return "\t".join(line) + "\n"
+    return encode_row
+
+def get_copy_query(table, columns, format="text"):
+    return "copy %s (%s) from stdin with (format %s)" % (table, ",".join(columns), format)
+
+class BodyTooLargeError(Exception):
+    pass
+
+class BoundedReader(object):
+    # Never reads past the request body, which can block on a raw WSGI input
+    def __init__(self, stream, length=None, max_length=None):
+        self.stream = stream
+        self.remaining = length
+        self.max_length = max_length
+        self.length = 0
+
+    def limit(self, size):
+        if self.remaining is None:
+            return size
+        return self.remaining if size is None or size < 0 else min(size, self.remaining)
+
+    def consumed(self, data):
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.length += len(data)
+        if self.max_length is not None and self.length > self.max_length:
+            raise BodyTooLargeError("Streamed bodies are limited to %d bytes" % self.max_length)
+        return data
+
+    def read(self, size=-1):
+        size = self.limit(size)
+        if size == 0:
+            return ""
+        return self.consumed(self.stream.read(size) if size is not None and size >= 0 else self.stream.read())
+
+    def readline(self, size=-1):
+        size = self.limit(size)
+        if size == 0:
+            return ""
+        return self.consumed(self.stream.readline(size) if size is not None and size >= 0 else self.stream.readline())
+
+def read_lines(stream):
+    for line in iter(stream.readline, ""):
+        line = line.strip()
+        if line:
+            yield line
+
+class NDJSONReader(object):
+    # File-like for copy_expert, encoding one JSON object per line into COPY lines as they are read
+    def __init__(self, lines, encode_row, column_count):
+        self.lines = lines
+        self.encode_row = encode_row
+        self.column_count = column_count
+        self.line_number = 0
+        # psycopg2 cancels the COPY on errors in read(), this keeps the reason
+        self.error = None
+
+    def decode(self, line):
+        self.line_number += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            raise ValueError("Could not decode JSON on line %d" % self.line_number)
+        if not isinstance(row, dict) or len(row) != self.column_count:
+            raise ValueError("Found jagged JSON on line %d" % self.line_number)
+        return row
+
+    def read(self, size=-1):
+        chunk = []
+        length = 0
+        for line in self.lines:
+            try:
+                data = self.encode_row(self.decode(line))
+            except KeyError:
+                self.error = "Found jagged JSON on line %d" % self.line_number
+                raise ValueError(self.error)
+            except ValueError, e:
+                self.error = str(e)
+                raise
+            chunk.append(data)
+            length += len(data)
+            if size >= 0 and length >= size:
+                break
+        return "".join(chunk)
@@ -0,0 +1,160 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import threading
+import time
+import psycopg2
+import settings
+import db
+import schema
+import notify
+import log
+import lru
+
+CHANNEL = "httpsql_cache"
+
+class ResponseCache(object):
+    # Entries are keyed by their collection's generation, so invalidating only bumps a counter
+    def __init__(self, size, ttl):
+        self.entries = lru.LRUCache(size)
+        self.ttl = float(ttl)
+        self.generation = 0
+        self.generations = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def key(self, table, path, query_string, variant=None):
+        return (
+            table,
+            self.generation,
+            self.generations[table],
+            path.rstrip("/"),
+            "&".join(sorted(query_string.split("&"))),
+            variant
+        )
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.time():
+            self.entries.pop(key)
+            return None
+        return value
+
+    def put(self, key, value):
+        self.entries.put(key, (time.time() + self.ttl, value))
+
+    def invalidate(self, table=None):
+        with self.lock:
+            if table is None:
+                self.generation += 1
+            else:
+                self.generations[table] += 1
+
+ENABLED = int(settings.API_RESPONSE_CACHE_SIZE) > 0
+RESPONSES = ResponseCache(settings.API_RESPONSE_CACHE_SIZE, settings.API_RESPONSE_CACHE_TTL_SECONDS)
+COUNTS_ENABLED = float(settings.API_COUNT_CACHE_TTL_SECONDS) > 0 and int(settings.API_COUNT_CACHE_SIZE) > 0
+COUNTS = ResponseCache(settings.API_COUNT_CACHE_SIZE, settings.API_COUNT_CACHE_TTL_SECONDS)
+
+def install_triggers(conn, tables):
+    # Every worker boots through here, so only tables still missing the trigger are touched
+    with conn.cursor() as c:
+        c.execute("""
+        select c.relname
+        from pg_class c
+        join pg_namespace n
+        on n.oid = c.relnamespace
+        where n.nspname = %s
+        and c.relkind = 'r'
+        and c.relname = any(%s)
+        and not exists (
+            select 1
+            from pg_trigger t
+            where t.tgrelid = c.oid
+            and t.tgname = 'httpsql_notify_change'
+        )
+        """, [settings.DB_SCHEMA, tables])
+        missing = [r[0] for r in c.fetchall()]
+        if not missing:
+            return
+        c.execute("""
+        create or replace function httpsql_notify_change() returns trigger as $$
+        begin
+            perform pg_notify('%s', tg_table_name);
+            return null;
+        end;
+        $$ language plpgsql
+        """ % CHANNEL)
+        for table in missing:
+            try:
+                c.execute("""
+                create trigger httpsql_notify_change
+                after insert or update or delete or truncate on %s
+                for each statement execute procedure httpsql_notify_change()
+                """ % table)
+            except psycopg2.ProgrammingError, e:
+                # Another worker booting at the same time got there first
+                if e.pgcode != "42710":
+                    raise
+
+def response_key(table, req, variant=None):
+    # Nothing read inside a batch's transaction is cached, it may be rolled back
+    if not ENABLED or db.in_transaction():
+        return None
+    notify.start()
+    return RESPONSES.key(table, req.path, req.query_string, variant)
+
+def get_response(key):
+    return RESPONSES.get(key) if key is not None else None
+
+def put_response(key, conn, body, headers=None):
+    # A lagging replica may still return what a write just invalidated, only the primary fills caches
+    if key is not None and not db.is_replica(conn):
+        RESPONSES.put(key, (body, headers or {}))
+
+def count_key(table, query, params):
+    if not COUNTS_ENABLED or db.in_transaction():
+        return None
+    notify.start()
+    return COUNTS.key(table, query, "", repr(params))
+
+def get_count(key):
+    return COUNTS.get(key) if key is not None else None
+
+def put_count(key, conn, count):
+    if key is not None and not db.is_replica(conn):
+        COUNTS.put(key, count)
+
+def invalidate_local(table=None):
+    RESPONSES.invalidate(table)
+    COUNTS.invalidate(table)
+
+def invalidate(conn, table):
+    # Other workers learn about the write through the DB
+    if ENABLED or COUNTS_ENABLED:
+        invalidate_local(table)
+        notify.publish(conn, CHANNEL, table)
+
+def install_schema_triggers():
+    if not db.DB_ONLINE or not schema.SNAPSHOT or not settings.API_RESPONSE_CACHE_INSTALL_TRIGGERS:
+        return
+    try:
+        with db.conn() as conn:
+            install_triggers(conn, list(schema.SNAPSHOT.schema.keys()))
+    except Exception, e:
+        log.error("Could not install cache triggers: %s" % str(e))
+
+def on_schema_reload():
+    # Tables created since boot are served after a reload, so they get their trigger then
+    invalidate_local()
+    install_schema_triggers()
+
+if ENABLED or COUNTS_ENABLED:
+    notify.subscribe(CHANNEL, invalidate_local)
+    schema.on_reload(on_schema_reload)
+    install_schema_triggers()
@@ -7,40 +7,480 @@
 import settings
 import psycopg2
 import psycopg2.pool
+import psycopg2.extensions
 import psycopg2.extras
+import threading
+import itertools
+import cStringIO
+import time
+import re
 import log
+import lru
+import metrics
+import slowlog
+
+try:
+    import gevent.monkey
+    import gevent.socket
+except ImportError:
+    gevent = None
 
 DB_ONLINE = False
 DB_POOL = None
+DB_REPLICAS = []
+HSTORE_OIDS = None
+STATEMENT_GENERATION = 0
+PLACEHOLDER_RE = re.compile(r"%(%|s)")
+
+class Connection(psycopg2.extensions.connection):
+    # Physical connection that remembers whether its one time setup ran
+    initialized = False
+    # Prepared statements by query text and the generation they belong to
+    statements = None
+    statement_generation = None
+    statement_count = 0
+    # Pool the connection is returned to
+    pool = None
+
+class PoolTimeoutError(psycopg2.pool.PoolError):
+    pass
+
+class BoundedConnectionPool(psycopg2.pool.AbstractConnectionPool):
+    # Thread safe pool where callers queue for a free connection instead of failing right away
+    def __init__(self, minconn, maxconn, max_waiters, timeout, *args, **kwargs):
+        self._cond = threading.Condition()
+        self.max_waiters = int(max_waiters)
+        self.timeout = float(timeout)
+        self.waiting = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.rejected = 0
+        # Slots reserved for connections being opened outside the lock
+        self.connecting = 0
+        psycopg2.pool.AbstractConnectionPool.__init__(self, minconn, maxconn, *args, **kwargs)
+
+    def _exhausted(self):
+        return not self._pool and len(self._used) + self.connecting >= self.maxconn
+
+    def getconn(self):
+        with self._cond:
+            waited = 0.0
+            if self._exhausted():
+                if self.waiting >= self.max_waiters:
+                    self.rejected += 1
+                    raise PoolTimeoutError("Connection pool wait queue is full")
+                start = time.time()
+                self.waiting += 1
+                try:
+                    while self._exhausted():
+                        remaining = start + self.timeout - time.time()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise PoolTimeoutError("Timed out waiting for a connection")
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                waited = time.time() - start
+                self.waits += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if self.closed or self._pool:
+                conn = self._getconn()
+                self.checkouts += 1
+                return conn
+            self.connecting += 1
+            key = self._getkey()
+
+        # Connecting can take up to the connect timeout, other callers keep using the pool meanwhile
+        try:
+            conn = psycopg2.connect(*self._args, **self._kwargs)
+        except:
+            with self._cond:
+                self.connecting -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.connecting -= 1
+            if self.closed:
+                conn.close()
+                raise psycopg2.pool.PoolError("connection pool is closed")
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+            self.checkouts += 1
+            return conn
+
+    def putconn(self, conn, close=False):
+        with self._cond:
+            self._putconn(conn, close=close)
+            self._cond.notify()
+
+    def in_use(self):
+        with self._cond:
+            return len(self._used)
+
+    def closeall(self):
+        with self._cond:
+            self._closeall()
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max"              : self.maxconn,
+                "in_use"           : len(self._used),
+                "idle"             : len(self._pool),
+                "connecting"       : self.connecting,
+                "waiting"          : self.waiting,
+                "checkouts"        : self.checkouts,
+                "waits"            : self.waits,
+                "wait_seconds"     : self.wait_seconds,
+                "max_wait_seconds" : self.max_wait_seconds,
+                "timeouts"         : self.timeouts,
+                "rejected"         : self.rejected
+            }
+
+###################################################################################################
+# Cooperative mode
+###################################################################################################
+
+def gevent_wait_callback(conn, timeout=None):
+    # Yields to other greenlets while psycopg2 waits on the server
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            gevent.socket.wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            gevent.socket.wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+def set_cooperative():
+    if gevent is None:
+        raise RuntimeError("DB_COOPERATIVE needs gevent installed")
+    # The pool's condition and the per request thread locals must be green too
+    if not gevent.monkey.is_module_patched("threading"):
+        raise RuntimeError("DB_COOPERATIVE needs gevent's monkey patching e.g. gunicorn -k gevent")
+    psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+    log.info("Cooperative DB mode enabled")
+
+# COPYs in progress, psycopg2 refuses to COPY while a wait callback is set
+COPYING = [0]
+
+def buffer_copy_source(source, size):
+    # Reading a request body yields to other greenlets, which must not find the wait callback unset
+    if isinstance(source, (cStringIO.InputType, cStringIO.OutputType)):
+        return source
+    buffered = cStringIO.StringIO()
+    for data in iter(lambda: source.read(size), ""):
+        buffered.write(data)
+    buffered.seek(0)
+    return buffered
+
+def copy_expert(c, query, source, size=8192):
+    # The worker's hub is blocked for the duration of the COPY in cooperative mode, so the source
+    # is read into memory first and the COPY itself never switches greenlets
+    start = time.time()
+    try:
+        if not settings.DB_COOPERATIVE:
+            return c.copy_expert(query, source, size)
+        source = buffer_copy_source(source, size)
+        COPYING[0] += 1
+        psycopg2.extensions.set_wait_callback(None)
+        try:
+            return c.copy_expert(query, source, size)
+        finally:
+            COPYING[0] -= 1
+            if not COPYING[0]:
+                psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+    finally:
+        metrics.observe(metrics.QUERY_DURATION, time.time() - start, (("operation", "copy"),))
+
+if settings.DB_COOPERATIVE:
+    set_cooperative()
+
+DB_CONNECTION_ARGS = {
+    "database"           : settings.DB_DATABASE,
+    "user"               : settings.DB_USER,
+    "password"           : settings.DB_PASSWORD,
+    "host"               : settings.DB_HOST,
+    "port"               : settings.DB_PORT,
+    "connect_timeout"    : settings.DB_CONNECTION_TIMEOUT_SECONDS,
+    "connection_factory" : Connection
+}
 
 try:
-    DB_POOL = psycopg2.pool.SimpleConnectionPool(
+    DB_POOL = BoundedConnectionPool(
         settings.DB_CONNECTION_POOL_MIN,
         settings.DB_CONNECTION_POOL_MAX,
-        database=settings.DB_DATABASE,
-        user=settings.DB_USER,
-        password=settings.DB_PASSWORD,
-        host=settings.DB_HOST,
-        port=settings.DB_PORT,
-        connect_timeout=settings.DB_CONNECTION_TIMEOUT_SECONDS
+        settings.DB_CONNECTION_POOL_MAX_WAITERS,
+        settings.DB_CONNECTION_POOL_TIMEOUT_SECONDS,
+        **DB_CONNECTION_ARGS
     )
     DB_ONLINE = True
     log.info("Connected to DB")
 except psycopg2.OperationalError, e:
     log.error("Could not connect to DB: %s" % str(e))
 
-def get_conn(autocommit=True):
-    conn = DB_POOL.getconn()
-    conn.autocommit = autocommit
+def get_hstore_oids(conn):
+    # The type OIDs don't change for the lifetime of the process
+    global HSTORE_OIDS
+    if HSTORE_OIDS is None:
+        HSTORE_OIDS = psycopg2.extras.HstoreAdapter.get_oids(conn)
+    return HSTORE_OIDS
+
+def init_conn(conn):
+    conn.autocommit = True
     try:
-        psycopg2.extras.register_hstore(conn)
-    except:
-        pass
+        oid, array_oid = get_hstore_oids(conn)
+        if oid:
+            psycopg2.extras.register_hstore(conn, oid=oid, array_oid=array_oid)
+    except Exception, e:
+        log.error("Could not register hstore: %s" % str(e))
+
+    session = [
+        ("application_name", settings.DB_APPLICATION_NAME),
+        ("search_path", settings.DB_SEARCH_PATH),
+        ("statement_timeout", settings.DB_STATEMENT_TIMEOUT_MS)
+    ]
+    session = [(name, str(value)) for name, value in session if value]
+    if session:
+        with conn.cursor() as c:
+            c.execute("select %s" % ",".join(["set_config(%s, %s, false)" for x in session]),
+                      [x for setting in session for x in setting])
+    conn.initialized = True
+
+def checkout(pool, autocommit=True):
+    start = time.time()
+    try:
+        conn = pool.getconn()
+    finally:
+        metrics.observe(metrics.POOL_CHECKOUT_DURATION, time.time() - start, (("pool", get_pool_name(pool)),))
+    conn.pool = pool
+    if not conn.initialized:
+        try:
+            init_conn(conn)
+        except:
+            pool.putconn(conn, close=True)
+            raise
+    conn.autocommit = autocommit
+    return conn
+
+def get_conn(autocommit=True, replica=False):
+    # Reads may go to a replica, falling back to the primary when none is current or reachable
+    if replica:
+        target = get_replica()
+        if target:
+            try:
+                return checkout(target.pool, autocommit)
+            except psycopg2.OperationalError, e:
+                target.down(e)
+    return checkout(DB_POOL, autocommit)
+
+def get_pool_name(pool):
+    if pool is DB_POOL:
+        return "primary"
+    for replica in DB_REPLICAS:
+        if replica.pool is pool:
+            return replica.name
+    return "unknown"
+
+def get_pool_gauges():
+    gauges = {}
+    for name, stats in [("primary", DB_POOL.stats())] + [(x.name, x.pool.stats()) for x in DB_REPLICAS]:
+        for state in ["in_use", "idle", "waiting"]:
+            gauges[(metrics.POOL_CONNECTIONS, (("pool", name), ("state", state)))] = stats[state]
+    return gauges
+
+def connect():
+    # Dedicated connection outside of the pool e.g. for LISTEN
+    conn = psycopg2.connect(**DB_CONNECTION_ARGS)
+    init_conn(conn)
     return conn
 
 def release_conn(conn):
     if conn:
-        DB_POOL.putconn(conn)
+        (conn.pool or DB_POOL).putconn(conn)
+
+###################################################################################################
+# Read replicas
+###################################################################################################
+
+class Replica(object):
+    def __init__(self, host):
+        host, _, port = host.strip().partition(":")
+        self.name = "%s:%s" % (host, port or settings.DB_PORT)
+        self.args = dict(DB_CONNECTION_ARGS, host=host, port=port or settings.DB_PORT)
+        # Connections are opened on demand, an unreachable replica must not keep the API from starting
+        self.pool = BoundedConnectionPool(
+            0,
+            settings.DB_CONNECTION_POOL_MAX,
+            settings.DB_CONNECTION_POOL_MAX_WAITERS,
+            settings.DB_CONNECTION_POOL_TIMEOUT_SECONDS,
+            **self.args
+        )
+        # Lag is measured in the background on a connection of its own, requests only read the last value
+        self.monitor = None
+        self.lag = None
+        self.checked = 0
+
+    def check_lag(self):
+        try:
+            if self.monitor is None or self.monitor.closed:
+                self.monitor = psycopg2.connect(**self.args)
+                self.monitor.autocommit = True
+            with self.monitor.cursor() as c:
+                c.execute(get_replica_lag_query(self.monitor))
+                lag = c.fetchone()[0]
+            self.lag = float(lag) if lag is not None else None
+            self.checked = time.time()
+        except psycopg2.Error, e:
+            self.down(e)
+
+    def get_lag(self):
+        # The replica may have fallen behind since, up to the time passed since the check
+        if self.lag is None:
+            return None
+        return self.lag + max(time.time() - self.checked, 0)
+
+    def down(self, e):
+        log.error("Replica %s is unavailable: %s" % (self.name, str(e)))
+        self.lag = None
+
+    def available(self):
+        lag = self.get_lag()
+        return lag is not None and lag <= float(settings.DB_REPLICA_MAX_LAG_SECONDS)
+
+    def stats(self):
+        return dict(self.pool.stats(), host=self.name, lag_seconds=self.lag)
+
+def get_replica_lag_query(conn):
+    # The last replay ages while the primary is idle too, a replica that replayed all it received is
+    # current. Unless it lost its upstream, then there may be more it never received.
+    names = ("wal", "lsn") if conn.server_version >= 100000 else ("xlog", "location")
+    streaming = "exists (select 1 from pg_stat_wal_receiver)" if conn.server_version >= 90600 else "true"
+    return """
+        select case
+            when not pg_is_in_recovery() then 0
+            when pg_last_%(0)s_receive_%(1)s() = pg_last_%(0)s_replay_%(1)s() and %(2)s then 0
+            else extract(epoch from now() - pg_last_xact_replay_timestamp())
+        end
+    """ % {"0" : names[0], "1" : names[1], "2" : streaming}
+
+def check_replica_lag():
+    for replica in DB_REPLICAS:
+        replica.check_lag()
+
+def is_replica(conn):
+    pool = getattr(conn, "pool", None)
+    return pool is not None and pool is not DB_POOL
+
+REPLICA_COUNTER = itertools.count()
+
+def get_replica():
+    replicas = [x for x in DB_REPLICAS if x.available()]
+    if not replicas:
+        return None
+    if settings.DB_REPLICA_BALANCE == "least_connections":
+        return min(replicas, key=lambda x: x.pool.in_use())
+    return replicas[next(REPLICA_COUNTER) % len(replicas)]
+
+if DB_ONLINE:
+    DB_REPLICAS = [Replica(x) for x in settings.DB_REPLICA_HOSTS.split(",") if x.strip()]
+    metrics.add_gauges(get_pool_gauges)
+
+###################################################################################################
+# Prepared statements
+###################################################################################################
+
+def invalidate_statements():
+    # Every connection drops its prepared statements on next use e.g. after a schema change
+    global STATEMENT_GENERATION
+    STATEMENT_GENERATION += 1
+
+def to_prepared_query(query):
+    count = [0]
+    def placeholder(match):
+        if match.group(1) == "%":
+            return "%"
+        count[0] += 1
+        return "$%d" % count[0]
+    return PLACEHOLDER_RE.sub(placeholder, query), count[0]
+
+def deallocate(conn, name):
+    try:
+        with conn.cursor() as c:
+            c.execute("deallocate %s" % name)
+    except psycopg2.Error, e:
+        log.debug("Could not deallocate %s: %s" % (name, str(e)))
+
+def get_statement_cache(conn):
+    if conn.statements is None or conn.statement_generation != STATEMENT_GENERATION:
+        if conn.statements is not None:
+            with conn.cursor() as c:
+                c.execute("deallocate all")
+        conn.statements = lru.LRUCache(
+            settings.DB_STATEMENT_CACHE_SIZE,
+            lambda query, statement: deallocate(conn, statement[0])
+        )
+        conn.statement_generation = STATEMENT_GENERATION
+    return conn.statements
+
+# Operations known to the query duration metric, anything else is counted as other
+OPERATIONS = set(["select", "insert", "update", "delete", "with", "copy", "prepare", "create", "drop"])
+
+def get_operation(query):
+    words = query.lstrip()[:8].split()
+    operation = words[0].lower() if words else ""
+    return operation if operation in OPERATIONS else "other"
+
+def observe_statement(c, query, params, duration, succeeded, explain):
+    metrics.observe(metrics.QUERY_DURATION, duration, (("operation", get_operation(query)),))
+    if slowlog.is_slow(duration):
+        slowlog.record(c, query, params, duration, succeeded, explain)
+
+def execute(c, query, params=None, prepare=False, explain=False):
+    # Only statements the caller marks as free of side effects may be rerun to explain them when slow
+    start = time.time()
+    try:
+        execute_statement(c, query, params, prepare)
+    except:
+        observe_statement(c, query, params, time.time() - start, False, explain)
+        raise
+    observe_statement(c, query, params, time.time() - start, True, explain)
+
+def execute_statement(c, query, params=None, prepare=False, retry=True):
+    conn = c.connection
+    if not prepare or not int(settings.DB_STATEMENT_CACHE_SIZE) or not isinstance(conn, Connection):
+        return c.execute(query, params)
+
+    statements = get_statement_cache(conn)
+    statement = statements.get(query)
+    if statement is None:
+        conn.statement_count += 1
+        name = "httpsql_%d" % conn.statement_count
+        prepared, param_count = to_prepared_query(query)
+        c.execute("prepare %s as %s" % (name, prepared))
+        statement = (name, "execute %s%s" % (
+            name,
+            ("(%s)" % ",".join(["%s" for x in range(param_count)])) if param_count else ""
+        ))
+        statements.put(query, statement)
+
+    try:
+        c.execute(statement[1], params)
+    except (psycopg2.NotSupportedError, psycopg2.ProgrammingError), e:
+        # Stale plan after DDL or a statement that vanished server side
+        if not retry or not conn.autocommit or e.pgcode not in ("0A000", "26000") \
+                or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            raise
+        statements.pop(query)
+        deallocate(conn, statement[0])
+        execute_statement(c, query, params, prepare, False)
 
 def dictfetchall(c):
     rows = []
@@ -54,11 +494,113 @@ def dictfetchall(c):
                 for x in range(len_cols):
                     row[cols[x]] = r[x]
                 rows.append(row)
+    metrics.add_rows(len(rows))
     return rows
 
-class conn:
+def compactfetchall(c):
+    # Column names once and the rows as fetched, without building a dict per row
+    if c and c.description:
+        rows = c.fetchall()
+        metrics.add_rows(len(rows))
+        return [desc[0] for desc in c.description], rows
+    return [], []
+
+class stream_rows:
+    # Server side cursor that holds its own connection until exhausted or closed
+    def __init__(self, query, params=None, compact=False, replica=False):
+        self.conn = get_conn(autocommit=False, replica=replica)
+        self.cursor = None
+        self.compact = compact
+        try:
+            self.cursor = self.conn.cursor("httpsql_stream")
+            self.cursor.itersize = int(settings.API_STREAM_ITERSIZE)
+            execute(self.cursor, query, params)
+        except:
+            self.close()
+            raise
+
+    def columns(self):
+        if self.cursor is None or self.cursor.description is None:
+            return []
+        return [desc[0] for desc in self.cursor.description]
+
+    def __iter__(self):
+        if self.compact:
+            for r in self.cursor:
+                yield r
+            return
+        cols = None
+        for r in self.cursor:
+            if cols is None:
+                cols = [desc[0] for desc in self.cursor.description]
+            yield dict(zip(cols, r))
+
+    def close(self):
+        if self.conn:
+            try:
+                if self.cursor:
+                    self.cursor.close()
+            except:
+                pass
+            release_conn(self.conn)
+            self.conn = None
+
+SAVEPOINT_COUNTER = itertools.count()
+
+class transaction:
+    # Explicit transaction on an autocommit connection, a savepoint inside one already open
+    def __init__(self, conn):
+        self.conn = conn
+        self.savepoint = None
+
+    def __enter__(self):
+        if self.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.savepoint = "httpsql_%d" % next(SAVEPOINT_COUNTER)
+        with self.conn.cursor() as c:
+            c.execute(("savepoint %s" % self.savepoint) if self.savepoint else "begin")
+        return self.conn
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            with self.conn.cursor() as c:
+                c.execute(("release savepoint %s" % self.savepoint) if self.savepoint else "commit")
+            return
+        try:
+            with self.conn.cursor() as c:
+                if self.savepoint:
+                    c.execute("rollback to savepoint %s" % self.savepoint)
+                    c.execute("release savepoint %s" % self.savepoint)
+                else:
+                    c.execute("rollback")
+        except Exception, e:
+            log.error("Could not roll back transaction: %s" % str(e))
+
+# Connection shared by all operations of a batch on this thread
+SHARED = threading.local()
+
+def get_shared_conn():
+    return getattr(SHARED, "conn", None)
+
+def in_transaction():
+    conn = get_shared_conn()
+    return conn is not None and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+class shared_conn:
     def __enter__(self):
         self.conn = get_conn()
+        SHARED.conn = self.conn
         return self.conn
     def __exit__(self, type, value, traceback):
+        SHARED.conn = None
         release_conn(self.conn)
+
+class conn:
+    def __init__(self, replica=False):
+        self.replica = replica
+    def __enter__(self):
+        self.shared = get_shared_conn()
+        self.conn = self.shared or get_conn(replica=self.replica)
+        return self.conn
+    def __exit__(self, type, value, traceback):
+        if self.shared is None:
+            release_conn(self.conn)
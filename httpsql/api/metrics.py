@@ -0,0 +1,239 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import time
+import errno
+import bisect
+import threading
+import settings
+import log
+
+# Prometheus text exposition, https://prometheus.io/docs/instrumenting/exposition_formats/
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+REQUEST_DURATION = "httpsql_request_duration_seconds"
+REQUESTS = "httpsql_requests_total"
+RESPONSE_BYTES = "httpsql_response_bytes_total"
+RESPONSE_ROWS = "httpsql_response_rows"
+SERIALIZE_DURATION = "httpsql_serialize_duration_seconds"
+QUERY_DURATION = "httpsql_query_duration_seconds"
+POOL_CHECKOUT_DURATION = "httpsql_pool_checkout_duration_seconds"
+POOL_CONNECTIONS = "httpsql_pool_connections"
+
+METRICS = {
+    REQUEST_DURATION       : (HISTOGRAM, "Request latency by route, collection and method", LATENCY_BUCKETS),
+    REQUESTS               : (COUNTER, "Requests by route, collection, method and status", None),
+    RESPONSE_BYTES         : (COUNTER, "Bytes of response bodies, streamed bodies excluded", None),
+    RESPONSE_ROWS          : (HISTOGRAM, "Rows fetched per request, streamed rows excluded", ROW_BUCKETS),
+    SERIALIZE_DURATION     : (HISTOGRAM, "Time spent encoding responses to JSON", LATENCY_BUCKETS),
+    QUERY_DURATION         : (HISTOGRAM, "Statement execution time by operation", LATENCY_BUCKETS),
+    POOL_CHECKOUT_DURATION : (HISTOGRAM, "Time to check out a pooled connection, including waits", LATENCY_BUCKETS),
+    POOL_CONNECTIONS       : (GAUGE, "Pooled connections by pool and state", None)
+}
+
+class Registry(object):
+    # Samples of this process, keyed by metric name and a tuple of label pairs
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        buckets = METRICS[name][2]
+        # Counts per bucket with +Inf last, made cumulative on exposition, and the sum
+        index = bisect.bisect_left(buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += value
+
+    def snapshot(self, gauges):
+        with self.lock:
+            return {
+                "pid"        : os.getpid(),
+                "counters"   : [[name, labels, value] for (name, labels), value in self.counters.items()],
+                "histograms" : [[name, labels, list(h[0]), h[1]] for (name, labels), h in self.histograms.items()],
+                "gauges"     : [[name, labels, value] for (name, labels), value in gauges.items()]
+            }
+
+REGISTRY = Registry()
+
+def inc(name, labels=(), value=1):
+    REGISTRY.inc(name, labels, value)
+
+def observe(name, value, labels=()):
+    REGISTRY.observe(name, value, labels)
+
+# Rows fetched by the request in progress on this thread
+REQUEST = threading.local()
+
+def start_request():
+    REQUEST.rows = 0
+
+def add_rows(count):
+    REQUEST.rows = getattr(REQUEST, "rows", 0) + count
+
+def get_request_rows():
+    return getattr(REQUEST, "rows", 0)
+
+# Gauges are read when sampled, from callbacks returning {(name, labels) : value}
+GAUGE_CALLBACKS = []
+
+def add_gauges(callback):
+    GAUGE_CALLBACKS.append(callback)
+
+def get_gauges():
+    gauges = {}
+    for callback in GAUGE_CALLBACKS:
+        try:
+            gauges.update(callback())
+        except Exception, e:
+            log.error("Could not sample gauges: %s" % str(e))
+    return gauges
+
+###################################################################################################
+# Prefork workers each write their samples to API_METRICS_DIR, a scrape adds them up
+###################################################################################################
+
+FLUSHER = None
+FLUSHER_LOCK = threading.Lock()
+
+def get_path(pid):
+    return os.path.join(settings.API_METRICS_DIR, "metrics_%d.json" % pid)
+
+def flush():
+    path = get_path(os.getpid())
+    # Renamed into place so a scrape never reads a partial file, one per thread as scrapes flush too
+    temp = "%s.%d.tmp" % (path, threading.current_thread().ident)
+    try:
+        if not os.path.isdir(settings.API_METRICS_DIR):
+            os.makedirs(settings.API_METRICS_DIR)
+        with open(temp, "w") as f:
+            json.dump(REGISTRY.snapshot(get_gauges()), f)
+        os.rename(temp, path)
+    except (IOError, OSError), e:
+        log.error("Could not write metrics to %s: %s" % (path, str(e)))
+
+class Flusher(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, name="httpsql-metrics")
+        self.daemon = True
+        self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            time.sleep(float(settings.API_METRICS_FLUSH_SECONDS))
+            flush()
+
+def start():
+    # Threads don't survive a fork so every worker process starts its own
+    global FLUSHER
+    if not settings.API_METRICS_DIR or (FLUSHER is not None and FLUSHER.pid == os.getpid()):
+        return
+    with FLUSHER_LOCK:
+        if FLUSHER is None or FLUSHER.pid != os.getpid():
+            FLUSHER = Flusher()
+            FLUSHER.start()
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def to_labels(labels):
+    return tuple([tuple(x) for x in labels])
+
+def collect():
+    # Counters and histograms of exited workers still count, gauges only of running ones
+    if not settings.API_METRICS_DIR:
+        return [REGISTRY.snapshot(get_gauges())]
+    flush()
+    snapshots = []
+    for name in os.listdir(settings.API_METRICS_DIR):
+        if not name.startswith("metrics_") or not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(settings.API_METRICS_DIR, name)) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError), e:
+            log.error("Could not read metrics from %s: %s" % (name, str(e)))
+            continue
+        if not is_alive(snapshot["pid"]):
+            snapshot["gauges"] = []
+        snapshots.append(snapshot)
+    return snapshots
+
+def merge(snapshots):
+    counters, histograms, gauges = {}, {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, to_labels(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total in snapshot["histograms"]:
+            key = (name, to_labels(labels))
+            if key in histograms:
+                histograms[key] = [[a + b for a, b in zip(histograms[key][0], counts)], histograms[key][1] + total]
+            else:
+                histograms[key] = [counts, total]
+        for name, labels, value in snapshot["gauges"]:
+            key = (name, to_labels(labels))
+            gauges[key] = gauges.get(key, 0) + value
+    return counters, histograms, gauges
+
+def escape(value):
+    return unicode(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (k, escape(v)) for k, v in labels])
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def expose():
+    counters, histograms, gauges = merge(collect())
+    samples = {}
+    for (name, labels), value in sorted(counters.items() + gauges.items()):
+        samples.setdefault(name, []).append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+    for (name, labels), (counts, total) in sorted(histograms.items()):
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(METRICS[name][2] + ("+Inf",), counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (name, format_labels(labels, [("le", bound)]), cumulative))
+        lines.append("%s_sum%s %s" % (name, format_labels(labels), repr(total)))
+        lines.append("%s_count%s %d" % (name, format_labels(labels), cumulative))
+    output = []
+    for name in sorted(samples):
+        _type, _help = METRICS[name][:2]
+        output.append("# HELP %s %s" % (name, _help))
+        output.append("# TYPE %s %s" % (name, _type))
+        output.extend(samples[name])
+    return ("\n".join(output) + "\n").encode("utf-8")
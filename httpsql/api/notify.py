@@ -0,0 +1,94 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import select
+import threading
+import time
+import settings
+import db
+import log
+
+HANDLERS = {}
+TASKS = []
+LISTENER = None
+LISTENER_LOCK = threading.Lock()
+
+def subscribe(channel, handler):
+    # Handlers get the notification payload, or None when notifications may have been missed
+    HANDLERS.setdefault(channel, []).append(handler)
+
+def schedule(interval, task):
+    # Tasks run on the listener thread, at most every interval seconds
+    TASKS.append({"interval" : float(interval), "task" : task, "last_run" : 0})
+
+def run_tasks():
+    now = time.time()
+    for task in TASKS:
+        if now - task["last_run"] >= task["interval"]:
+            task["last_run"] = now
+            try:
+                task["task"]()
+            except Exception, e:
+                log.error("Scheduled task failed: %s" % str(e))
+
+def get_timeout():
+    # Wake up for the most frequent task even when no notifications arrive
+    return min([float(settings.DB_LISTEN_POLL_SECONDS)] + [x["interval"] for x in TASKS])
+
+def publish(conn, channel, payload):
+    with conn.cursor() as c:
+        c.execute("select pg_notify(%s, %s)", [channel, payload])
+
+def dispatch(channel, payload):
+    for handler in HANDLERS.get(channel, []):
+        try:
+            handler(payload)
+        except Exception, e:
+            log.error("Notification handler for %s failed: %s" % (channel, str(e)))
+
+class Listener(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, name="httpsql-listener")
+        self.daemon = True
+        self.pid = os.getpid()
+
+    def listen(self):
+        conn = db.connect()
+        try:
+            with conn.cursor() as c:
+                for channel in HANDLERS:
+                    c.execute("listen %s" % channel)
+            # Anything could have changed while we weren't listening
+            for channel in HANDLERS:
+                dispatch(channel, None)
+            while True:
+                if select.select([conn], [], [], get_timeout()) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        notification = conn.notifies.pop(0)
+                        dispatch(notification.channel, notification.payload)
+                run_tasks()
+        finally:
+            conn.close()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception, e:
+                log.error("Listener connection lost: %s" % str(e))
+                time.sleep(float(settings.DB_LISTEN_RETRY_SECONDS))
+
+def start():
+    # Threads don't survive a fork so every worker process starts its own
+    global LISTENER
+    if LISTENER is not None and LISTENER.pid == os.getpid():
+        return
+    with LISTENER_LOCK:
+        if LISTENER is None or LISTENER.pid != os.getpid():
+            LISTENER = Listener()
+            LISTENER.start()
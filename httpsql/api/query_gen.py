@@ -5,8 +5,14 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import schema
+import settings
+import lru
+import bulk
 import cStringIO
 import json
+import csv
+import codecs
+import itertools
 
 JSON_TYPE = "jsonb"
 HSTORE_TYPE = "hstore"
@@ -19,15 +25,27 @@ QUERY_OPERATORS = {
     "not"      : ("Not equal to",             "%s::text <> %s::text"),
     "exact"    : ("Equal to",                 "%s::text = %s::text"),
     "contains" : ("Contains i.e. like",       "%s::text like %s::text"),
-    "match"    : ("Regex match",              "%s::text ~ %s::text")
+    "match"    : ("Regex match",              "%s::text ~ %s::text"),
+    "in"       : ("Any of a comma separated list",  "%s = any(%s)"),
+    "not_in"   : ("None of a comma separated list", "%s <> all(%s)")
 }
 
+# Operators comparing against a single array parameter, so one plan serves any number of values
+ARRAY_OPERATORS = ["in", "not_in"]
+# Column types compared as text in array operators
+ARRAY_TEXT_TYPES = [JSON_TYPE, HSTORE_TYPE, "json", "ARRAY", "character"]
+
+OPERATOR_MAP = {x : QUERY_OPERATORS[x][1] for x in QUERY_OPERATORS}
+
+# Compiled SQL and parameter extractors by table and filter signature
+COMPILED_QUERIES = lru.LRUCache(settings.API_QUERY_CACHE_SIZE)
+
 class QueryGenError(Exception):
     def __init__(self, msg):
         Exception.__init__(self, msg)
 
 def typeify(_dict, table):
-    columns = schema.SCHEMA[table]["columns"]
+    columns = schema.current().schema[table]["columns"]
     for key in _dict:
         ctype = columns[key]
         val = _dict[key]
@@ -46,70 +64,260 @@ def get_order_by(table, columns):
         ))
     return "order by %s" % ",".join(ordering)
 
+def get_keyset_condition(table, order, nulls):
+    # Row value comparison only walks the index in one direction. Returns the condition and the
+    # cursor value index of each of its parameters.
+    directions = set([x.find("-") == 0 for x in order])
+    if len(directions) != 1:
+        raise QueryGenError("Cursor pagination requires all order_by fields to share one direction")
+    descending = directions.pop()
+    columns = [x.replace("-", "") for x in order]
+    nulls = nulls or [False] * len(columns)
+    nullable = schema.current().schema[table].get("nullable", [])
+    if not [x for x in columns if x in nullable]:
+        return "(%s) %s (%s)" % (
+            ",".join(columns),
+            "<" if descending else ">",
+            ",".join(["%s" for x in columns])
+        ), range(len(columns))
+
+    # Comparisons with null are null, so spell out the order i.e. nulls last ascending, first descending
+    terms, indexes = [], []
+    for i, column in enumerate(columns):
+        if nulls[i]:
+            if not descending:
+                continue
+            after = "%s is not null" % column
+        elif column in nullable and not descending:
+            after = "(%s > %%s or %s is null)" % (column, column)
+        else:
+            after = "%s %s %%s" % (column, "<" if descending else ">")
+        term = []
+        for j in range(i):
+            term.append(("%s is null" % columns[j]) if nulls[j] else ("%s = %%s" % columns[j]))
+            if not nulls[j]:
+                indexes.append(j)
+        term.append(after)
+        if not nulls[i]:
+            indexes.append(i)
+        terms.append("(%s)" % " and ".join(term))
+    return "(%s)" % (" or ".join(terms) or "false"), indexes
+
+TOTAL_COLUMN = "__httpsql_total"
+
 def get_row_count_query(base_query):
     return "select count(*) as \"count\" from (%s) count_base" % base_query
 
-def get_filtered_rows_query(table, filters, limit=None, offset=None, order=None):
-    operator_map = {x : QUERY_OPERATORS[x][1] for x in QUERY_OPERATORS}
-    columns = schema.SCHEMA[table]["columns"]
+def get_planned_row_count_query(base_query):
+    return "explain (format json) %s" % base_query
 
-    blocks = []
-    params = []
+def get_estimated_row_count_query():
+    # reltuples is -1 until the table was first vacuumed or analyzed, views have no estimate
+    return """
+    select case when c.relkind in ('r', 'm') then c.reltuples else -1 end
+    from pg_class c
+    join pg_namespace n
+    on n.oid = c.relnamespace
+    where n.nspname = %s
+    and c.relname = %s
+    """
+
+def get_filter_signature(table, filters):
+    # Filter keys plus any column a filter compares against, i.e. all that shapes the SQL
+    columns = schema.current().schema[table]["columns"]
+    signature = []
     for f in filters:
-        chunks = f.split("__")
-        if len(chunks) != 2:
+        if len(f.split("__")) != 2:
             continue
-        column = chunks[0]
-        operator = chunks[1]
+        val = filters[f]
+        if f.split("__")[1] in ARRAY_OPERATORS:
+            val = None
+        signature.append((f, val if isinstance(val, basestring) and val in columns else None))
+    signature.sort()
+    return tuple(signature)
+
+def compile_filters(table, signature, strict=False):
+    # Filters that can't apply are skipped for reads, writes are strict so they never widen
+    columns = schema.current().schema[table]["columns"]
+
+    blocks = []
+    extractors = []
+    for f, val_column in signature:
+        column, operator = f.split("__")
+
+        # Must be a valid operator
+        if operator not in OPERATOR_MAP:
+            raise QueryGenError("Bad operator for filter. Valid operators are: %s" %  ", ".join(OPERATOR_MAP.keys()))
 
         # Dot syntax for drilling into hstore columns with operators
         is_map_ref = column.find(".") >= 0
         if is_map_ref:
-            column_chunks = column.split(".")
-            column = column_chunks[0]
-            # Should work for both hstore and jsonb
-            op = "->" if columns[column] == HSTORE_TYPE else "->>"
-            column_ref = "%s%s'%s'" % (column_chunks[0], op, column_chunks[1])
-        else:
-            column_ref = column        
-        
-        # Must be a valid operator
-        if operator not in operator_map:
-            raise QueryGenError("Bad operator for filter. Valid operators are: %s" %  ", ".join(operator_map.keys()))
+            column, key = column.split(".", 1)
+
         # Must be a column that exists in the schema
         if column not in columns:
             raise QueryGenError("Invalid field. Valid fields are: %s" % ", ".join(columns.keys()))
-        # No dot syntax for non map type's columns
-        if columns[column] not in (HSTORE_TYPE, JSON_TYPE) and is_map_ref:
-            print column
+
+        if is_map_ref:
+            # No dot syntax for non map type's columns
+            if columns[column] not in (HSTORE_TYPE, JSON_TYPE):
+                if strict:
+                    raise QueryGenError("Dot syntax only applies to %s and %s fields" % (HSTORE_TYPE, JSON_TYPE))
+                continue
+            # Should work for both hstore and jsonb
+            op = "->" if columns[column] == HSTORE_TYPE else "->>"
+            column_ref = "%s%s'%s'" % (column, op, key)
+        else:
+            column_ref = column
+
+        if operator in ARRAY_OPERATORS:
+            array_type = "text" if is_map_ref or columns[column] in ARRAY_TEXT_TYPES else columns[column]
+            extractors.append((f, operator))
+            # Values arrive as text, cast to the column's type so its index can be used
+            blocks.append(OPERATOR_MAP[operator] % (
+                column_ref if array_type != "text" else "(%s)::text" % column_ref,
+                "%s::text[]" if array_type == "text" else "%%s::text[]::%s[]" % array_type
+            ))
             continue
-        val = filters[f]
-        val_is_column = val in columns
-        if not val_is_column:
-            params.append("%%%s%%" % val if operator == "contains" else val)
+
+        if val_column is None:
+            extractors.append((f, operator))
         # Contains on another column is not allowed (yet)
-        if val_is_column and operator == "contains":
+        elif operator == "contains":
+            if strict:
+                raise QueryGenError("The contains operator can't compare against another field")
             continue
-        blocks.append(operator_map[operator] % (
+        blocks.append(OPERATOR_MAP[operator] % (
             column_ref, 
             "%s"
-            if not val_is_column else val
+            if val_column is None else val_column
         ))
+    return blocks, extractors
+
+def compile_filtered_rows_query(table, signature, order=None, keyset=None, limit=False, offset=False, total=False):
+    # Keyed by schema version, so a request still on the old snapshot can't fill in an outdated query
+    key = (schema.current().version, table, signature, tuple(order or ()), keyset, limit, offset, total)
+    compiled = COMPILED_QUERIES.get(key)
+    if compiled is None:
+        blocks, extractors = compile_filters(table, signature)
+
+        # Keyset pagination i.e. only rows sorting after the last row of the previous page
+        if keyset is not None:
+            keyset_condition = get_keyset_condition(table, order, keyset)[0]
+            if keyset:
+                blocks.append(keyset_condition)
+
+        compiled = ("select * from %s %s %s %s %s %s" % (
+            table,
+            "where" if len(blocks) > 0 else "",
+            " and ".join(blocks),
+            get_order_by(table, order) if order else "",
+            "limit %s" if limit else "",
+            "offset %s" if offset else ""
+        ), extractors)
+
+        # Total of all matching rows as an extra last column. The count only runs when the page is
+        # full, a short page already tells the total.
+        if total and limit:
+            compiled = ("select page.*, case when count(*) over () < %s then %s + count(*) over () "
+                "else (select count(*) from " + table + (" where " if blocks else "") + " and ".join(blocks) +
+                ") end as " + TOTAL_COLUMN + " from (" + compiled[0] + ") page " +
+                (get_order_by(table, order) if order else ""), extractors)
+        COMPILED_QUERIES.put(key, compiled)
+    return compiled
+
+def get_filter_param(val, operator):
+    if operator == "contains":
+        return "%%%s%%" % val
+    elif operator in ARRAY_OPERATORS:
+        # Falcon splits comma separated values into lists
+        return val if isinstance(val, list) else [val]
+    return val
+
+def get_filter_params(filters, extractors):
+    return [get_filter_param(filters[f], operator) for f, operator in extractors]
 
-    return "select * from %s %s %s %s %s %s" % (
+def get_filtered_rows_query(table, filters, limit=None, offset=None, order=None, after=None, total=False):
+    total = total and bool(limit) and after is None
+    query, extractors = compile_filtered_rows_query(
         table,
-        "where" if len(blocks) > 0 else "",
-        " and ".join(blocks),
-        get_order_by(table, order) if order else "",
-        ("limit %s" % limit) if limit else "",
-        ("offset %s" % offset) if offset else ""
-    ), params
+        get_filter_signature(table, filters),
+        order,
+        None if after is None else tuple([x is None for x in after]),
+        bool(limit),
+        bool(offset),
+        total
+    )
+
+    params = get_filter_params(filters, extractors)
+    if total:
+        params = [int(limit), int(offset or 0)] + params + params
+    if after:
+        indexes = get_keyset_condition(table, order, [x is None for x in after])[1]
+        params.extend([after[x] for x in indexes])
+    # Bound rather than inlined so every page shares one prepared statement
+    if limit:
+        params.append(int(limit))
+    if offset:
+        params.append(int(offset))
+    return query, params
+
+def compile_filtered_write_query(table, signature, columns=None, returning=None):
+    # An update when columns to set are passed, a delete otherwise
+    key = (schema.current().version, "write", table, signature, columns, returning)
+    compiled = COMPILED_QUERIES.get(key)
+    if compiled is None:
+        blocks, extractors = compile_filters(table, signature, True)
+
+        # Never touch the whole table by accident
+        if len(blocks) == 0:
+            raise QueryGenError("Updates and deletes by query require at least one filter")
+
+        if columns is not None:
+            table_columns = schema.current().schema[table]["columns"]
+            for column in columns:
+                if column not in table_columns:
+                    raise QueryGenError("Invalid field. Valid fields are: %s" % ", ".join(table_columns.keys()))
+            query = "update %s set %s" % (table, ",".join(["%s = %%s" % x for x in columns]))
+        else:
+            query = "delete from %s" % table
+
+        compiled = ("%s where %s %s" % (
+            query,
+            " and ".join(blocks),
+            ("returning %s" % returning) if returning else ""
+        ), extractors)
+        COMPILED_QUERIES.put(key, compiled)
+    return compiled
+
+def check_write_filters(filters):
+    # Keys the signature leaves out would otherwise be ignored
+    for f in filters:
+        if f.find("__") >= 0 and len(f.split("__")) != 2:
+            raise QueryGenError("Invalid filter '%s'" % f)
+
+def get_filtered_update_query(table, filters, _dict, returning=None):
+    if len(_dict) == 0:
+        raise QueryGenError("No fields to update passed")
+    check_write_filters(filters)
+    columns = tuple(sorted(_dict.keys()))
+    query, extractors = compile_filtered_write_query(table, get_filter_signature(table, filters), columns, returning)
+    typeify(_dict, table)
+    return query, [_dict[x] for x in columns] + get_filter_params(filters, extractors)
+
+def get_filtered_delete_query(table, filters, returning=None):
+    check_write_filters(filters)
+    query, extractors = compile_filtered_write_query(table, get_filter_signature(table, filters), None, returning)
+    return query, get_filter_params(filters, extractors)
+
+def clear_compiled_queries():
+    COMPILED_QUERIES.clear()
             
 def get_function_query(function, args=[], limit=None, offset=None, order=None):
     return "select * from %s(%s) %s %s %s" % (
         function, 
         ",".join(["%s := %%s" % arg for arg in args]),
-        get_order_by(table, order) if order else "",
+        get_order_by(function, order) if order else "",
         ("limit %s" % limit) if limit else "",
         ("offset %s" % offset) if offset else ""
     ), [args[arg] for arg in args]
@@ -125,60 +333,111 @@ def get_table_rows_query(table, limit=None, offset=None, order=None):
 def get_table_row_query(pk_lookup, table, pk):
     return "select * from %s where %s = %%s " % (table, pk_lookup[table])
 
-def delete_table_row_query(pk_lookup, table, pk):
-    return "delete from %s where %s = %%s " % (table, pk_lookup[table])
+def delete_table_row_query(pk_lookup, table, pk, returning=False):
+    return "delete from %s where %s = %%s %s" % (table, pk_lookup[table], "returning *" if returning else "")
 
-def insert_table_row_query(table, _dict):
+def insert_table_row_query(table, _dict, returning=False):
     values = ",".join(["%s" for x in _dict])
     columns = ",".join(["%s" % x for x in _dict])
-    if table in schema.PKS:
-        returning = "returning *" # % schema.PKS[table]
-    else:
-        returning = ""
-    return "insert into %s (%s) values(%s) %s" % (table, columns, values, returning)
+    return "insert into %s (%s) values(%s) %s" % (table, columns, values, "returning *" if returning else "")
 
-def insert_table_rows_query(table, _list):
-    _dict = _list[0]
-    _dict_len = len(_dict)
-    columns = ",".join(["%s" % x for x in _dict])
-    pg_copy_separator = "~"
-    pg_copy_csv_quote = "`"
-    pg_copy_lb = "\n"
-
-    def copy_escape(val):
-      return str(val).replace(pg_copy_separator, "").replace(pg_copy_csv_quote, "").replace(pg_copy_lb, "") 
-
-    def normalize_value(val, ctype):
-        if ctype == HSTORE_TYPE and isinstance(val, dict):
-            hstore_buff = []
-            for key in val:
-                hstore_buff.append('"%s"=>"%s"' % (key, copy_escape(val[key]).replace('"',"")))
-            return ",".join(hstore_buff)
-        elif ctype == JSON_TYPE and isinstance(val, dict) or isinstance(val, list):
-            return json.dumps(val)
-        else:
-            return copy_escape(val)
+def check_copy_columns(table, columns):
+    types = schema.current().schema[table]["columns"]
+    for column in columns:
+        if column not in types:
+            raise QueryGenError("Invalid field. Valid fields are: %s" % ", ".join(types.keys()))
+    if len(set(columns)) != len(columns):
+        raise QueryGenError("Duplicate fields passed")
+    return types
+
+def get_copy_encoder(table, columns):
+    key = (schema.current().version, "copy", table, columns)
+    encoder = COMPILED_QUERIES.get(key)
+    if encoder is None:
+        encoder = bulk.compile_row_encoder(columns, check_copy_columns(table, columns))
+        COMPILED_QUERIES.put(key, encoder)
+    return encoder
+
+# COPY sources i.e. the columns, a file-like for copy_expert and the COPY format
+
+def get_rows_copy_source(table, _list):
+    if not _list:
+        return None, None, None
+    columns = tuple(sorted(_list[0].keys()))
+    column_count = len(columns)
+    encode_row = get_copy_encoder(table, columns)
 
     records_to_insert_buffer = cStringIO.StringIO()
     for _dict in _list:
-        if len(_dict) != _dict_len:
+        if len(_dict) != column_count:
             raise QueryGenError("Found jagged JSON when importing multiple rows")
-        row = pg_copy_separator.join(
-            [normalize_value(_dict[x], schema.SCHEMA[table]["columns"][x]) for x in _dict]
-        ) + "\n"
+        try:
+            records_to_insert_buffer.write(encode_row(_dict))
+        except KeyError:
+            raise QueryGenError("Found jagged JSON when importing multiple rows")
+
+    records_to_insert_buffer.seek(0)
+    return columns, records_to_insert_buffer, "text"
 
-        records_to_insert_buffer.write(row)
+def get_ndjson_copy_source(table, stream):
+    # The first object's fields name the columns, the rest are encoded while COPY reads them
+    lines = bulk.read_lines(stream)
+    first = next(lines, None)
+    if first is None:
+        return None, None, None
+    try:
+        columns = tuple(sorted(json.loads(first).keys()))
+    except (ValueError, AttributeError):
+        raise QueryGenError("Could not decode JSON on line 1")
+    reader = bulk.NDJSONReader(itertools.chain([first], lines), get_copy_encoder(table, columns), len(columns))
+    return columns, reader, "text"
 
-    copy_stmt = "COPY %s(%s) FROM STDIN WITH DELIMITER '%s' CSV QUOTE '%s'" % (
-        table,
-        columns,
-        pg_copy_separator,
-        pg_copy_csv_quote
-    )
+def get_csv_copy_source(table, stream):
+    # Only the header is parsed here, Postgres parses the rows straight from the stream
+    header = stream.readline()
+    if header.startswith(codecs.BOM_UTF8):
+        header = header[len(codecs.BOM_UTF8):]
+    if not header.strip():
+        return None, None, None
+    try:
+        columns = tuple([x.strip() for x in csv.reader([header]).next()])
+    except csv.Error, e:
+        raise QueryGenError("Could not decode CSV header: %s" % str(e))
+    check_copy_columns(table, columns)
+    return columns, stream, "csv"
 
-    records_to_insert_buffer.seek(0)
-    return copy_stmt, records_to_insert_buffer
+def insert_table_rows_query(table, _list):
+    columns, buff, format = get_rows_copy_source(table, _list)
+    return bulk.get_copy_query(table, columns, format), buff
+
+UPSERT_TABLE = "httpsql_upsert"
+
+def upsert_table_rows_queries(pk_lookup, table, columns, format):
+    # Stage the rows in a temporary table, then merge them in one statement.
+    # Dropped right after, a later upsert in the same batch transaction creates it again.
+    pk = pk_lookup[table]
+    if pk not in columns:
+        raise QueryGenError("Upserts require the primary key field '%s'" % pk)
+    column_list = ",".join(columns)
+    updates = ",".join(["%s = excluded.%s" % (x, x) for x in columns if x != pk])
+    return (
+        "create temporary table %s on commit drop as select %s from %s with no data" % (UPSERT_TABLE, column_list, table),
+        bulk.get_copy_query(UPSERT_TABLE, columns, format),
+        """
+        with upserted as (
+            insert into %s (%s)
+            select %s from %s
+            on conflict (%s) do %s
+            returning (xmax = 0) as inserted
+        )
+        select
+        count(*) filter (where inserted) as inserted,
+        count(*) filter (where not inserted) as updated
+        from upserted
+        """ % (table, column_list, column_list, UPSERT_TABLE, pk, ("update set %s" % updates) if updates else "nothing"),
+        "drop table %s" % UPSERT_TABLE
+    )
 
-def update_table_row_query(pk_lookup, table, _dict):
+def update_table_row_query(pk_lookup, table, _dict, returning=True):
     sets = ",".join(["%s = %%s" % x for x in _dict])
-    return "update %s set %s where %s = %%s returning *" % (table, sets, pk_lookup[table])
\ No newline at end of file
+    return "update %s set %s where %s = %%s %s" % (table, sets, pk_lookup[table], "returning *" if returning else "")
\ No newline at end of file
@@ -5,14 +5,24 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import collections
+import hashlib
+import itertools
+import json
+import threading
 import settings
 import db
 import log
+import notify
 import query_gen
 
-SCHEMA    = None
-FUNCTIONS = None
-PKS       = None
+CHANNEL = "httpsql_schema"
+
+SNAPSHOT = None
+VERSIONS = itertools.count(1)
+# Snapshot a request pinned, so a reload in the middle of it can't mix two versions
+REQUEST = threading.local()
+RELOAD_LOCK = threading.Lock()
+RELOAD_HANDLERS = []
 
 def get_schema(conn):
     functions = collections.OrderedDict()
@@ -52,7 +62,8 @@ def get_schema(conn):
             and table_name = x.table_name
             limit 1
         ) as methods,
-        obj_description(x.table_name::regclass, 'pg_class') as table_comments
+        obj_description(x.table_name::regclass, 'pg_class') as table_comments,
+        x.is_nullable = 'YES' as is_nullable
         from information_schema.columns x
         where table_catalog = %s
         and table_schema= %s
@@ -74,6 +85,7 @@ def get_schema(conn):
             is_pk     = r[3]
             methods   = r[4]
             comments  = r[5]
+            nullable  = r[6]
 
             if obj not in schema:
                 schema[obj] = {
@@ -81,13 +93,18 @@ def get_schema(conn):
                     "methods" : methods,
                     "comments" : comments,
                     "endpoint" : "/collection/%s/" % obj,
+                    "primary_key" : None,
+                    "nullable" : [],
                     "operators" : {x : query_gen.QUERY_OPERATORS[x][0] for x in query_gen.QUERY_OPERATORS}
                 }
 
             schema[obj]["columns"][column] = data_type
+            if nullable:
+                schema[obj]["nullable"].append(column)
 
             if is_pk:
                 pks[obj] = column
+                schema[obj]["primary_key"] = column
 
         c.execute("""
         select
@@ -108,7 +125,12 @@ def get_schema(conn):
             LEFT JOIN pg_description As d ON (d.objoid = p.oid )
             WHERE  p.proname = routines.routine_name
             limit 1
-        ) as routine_comments
+        ) as routine_comments,
+        (
+            select p.provolatile <> 'v'
+            from pg_proc p
+            where routines.specific_name = p.proname || '_' || p.oid
+        ) as routine_read_only
         from information_schema.routines
         full outer join information_schema.parameters
         on routines.specific_name = parameters.specific_name
@@ -124,7 +146,7 @@ def get_schema(conn):
         """, [settings.DB_SCHEMA, settings.DB_USER])
 
         for r in c:
-            routine_name, routine_data_type, parameter_name, parameter_data_type, routine_comments = r
+            routine_name, routine_data_type, parameter_name, parameter_data_type, routine_comments, routine_read_only = r
             if routine_name in functions:
                 routine = functions[routine_name]
             else:
@@ -136,7 +158,9 @@ def get_schema(conn):
                     "endpoint" : "/function/%s/" % routine_name,
                     "type" : routine_data_type,
                     "parameters" : collections.OrderedDict(),
-                    "methods" : ["GET", "POST"]
+                    "methods" : ["GET", "POST"],
+                    # Stable and immutable functions can't write, so they may run on a replica
+                    "read_only" : routine_read_only is True
                 }
 
             if parameter_name:
@@ -145,8 +169,114 @@ def get_schema(conn):
 
     return schema, functions, pks
 
+def get_documents(schema, functions):
+    # Encoded once per schema version along with their ETag
+    documents = {}
+    for name, obj in (
+        ("all",        {"collection" : schema, "function" : functions}),
+        ("collection", schema),
+        ("function",   functions)
+    ):
+        body = json.dumps(obj, sort_keys=True)
+        documents[name] = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+    return documents
+
+def get_fingerprint(conn):
+    # Cheap catalog version, any DDL touching the schema's relations, columns or functions changes it
+    with conn.cursor() as c:
+        c.execute("""
+        select md5(coalesce(string_agg(x, ',' order by x), ''))
+        from (
+            select c.oid || ':' || c.xmin || ':' || (
+                select string_agg(a.attnum || ':' || a.xmin, ',')
+                from pg_attribute a
+                where a.attrelid = c.oid
+            ) as x
+            from pg_class c
+            join pg_namespace n
+            on n.oid = c.relnamespace
+            where n.nspname = %s
+            and c.relkind in ('r', 'v', 'm', 'f', 'p')
+            union all
+            select p.oid || ':' || p.xmin
+            from pg_proc p
+            join pg_namespace n
+            on n.oid = p.pronamespace
+            where n.nspname = %s
+        ) catalog
+        """, [settings.DB_SCHEMA, settings.DB_SCHEMA])
+        return c.fetchone()[0]
+
+class Snapshot(object):
+    # Never modified once built, reloads swap in a new one
+    def __init__(self, schema, functions, pks, fingerprint):
+        self.schema = schema
+        self.functions = functions
+        self.pks = pks
+        self.documents = get_documents(schema, functions)
+        self.fingerprint = fingerprint
+        # Part of cache keys derived from this snapshot
+        self.version = next(VERSIONS)
+
+def pin():
+    REQUEST.snapshot = SNAPSHOT
+    return SNAPSHOT
+
+def current():
+    return getattr(REQUEST, "snapshot", None) or SNAPSHOT
+
+def on_reload(handler):
+    RELOAD_HANDLERS.append(handler)
+
+def swap(snapshot):
+    global SNAPSHOT
+    SNAPSHOT = snapshot
+    query_gen.clear_compiled_queries()
+    db.invalidate_statements()
+    for handler in RELOAD_HANDLERS:
+        handler()
+
+def reload(force=False):
+    with RELOAD_LOCK:
+        with db.conn() as conn:
+            fingerprint = get_fingerprint(conn)
+            if not force and SNAPSHOT is not None and SNAPSHOT.fingerprint == fingerprint:
+                return False
+            log.debug("Start retrieve schema")
+            schema, functions, pks = get_schema(conn)
+            swap(Snapshot(schema, functions, pks, fingerprint))
+            log.debug("Finish retrieve schema")
+    return True
+
+def install_event_trigger(conn):
+    with conn.cursor() as c:
+        c.execute("""
+        create or replace function httpsql_notify_ddl() returns event_trigger as $$
+        begin
+            perform pg_notify('%s', '');
+        end;
+        $$ language plpgsql
+        """ % CHANNEL)
+        c.execute("drop event trigger if exists httpsql_notify_ddl")
+        c.execute("create event trigger httpsql_notify_ddl on ddl_command_end execute procedure httpsql_notify_ddl()")
+
+def watch():
+    # Reloads happen in the background so requests never wait on them
+    if SNAPSHOT is None or float(settings.SCHEMA_POLL_SECONDS) > 0 or settings.SCHEMA_INSTALL_EVENT_TRIGGER:
+        notify.start()
+
 if db.DB_ONLINE:
-    log.debug("Start retrieve schema")
-    with db.conn() as conn:
-        SCHEMA, FUNCTIONS, PKS = get_schema(conn)
-        log.debug("Finish retrieve schema")
+    try:
+        reload()
+    except Exception, e:
+        log.error("Could not retrieve schema: %s" % str(e))
+    if settings.SCHEMA_INSTALL_EVENT_TRIGGER:
+        try:
+            with db.conn() as conn:
+                install_event_trigger(conn)
+        except Exception, e:
+            log.error("Could not install schema event trigger: %s" % str(e))
+
+notify.subscribe(CHANNEL, lambda payload: reload())
+if float(settings.SCHEMA_POLL_SECONDS) > 0:
+    notify.schedule(settings.SCHEMA_POLL_SECONDS, reload)
@@ -0,0 +1,155 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import json
+import settings
+
+from decimal import Decimal
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+ENCODER_JSON = "json"
+ENCODER_SIMPLEJSON = "simplejson"
+ENCODER_UJSON = "ujson"
+ENCODER_AUTO = "auto"
+
+def isoformat(obj):
+    return obj.isoformat()
+
+def finite(obj):
+    # NaN and infinity aren't JSON, they are sent as null
+    return obj if obj - obj == 0 else None
+
+def to_float(obj):
+    return finite(float(obj))
+
+# Conversions for the non JSON types psycopg2 returns, looked up by exact type
+CONVERTERS = {
+    datetime.datetime : isoformat,
+    datetime.date     : isoformat,
+    datetime.time     : isoformat,
+    Decimal           : to_float,
+    buffer            : unicode
+}
+
+# Values are prepared up front for ujson, which has no hook and refuses non finite floats
+PREPARE_CONVERTERS = dict(CONVERTERS)
+PREPARE_CONVERTERS[float] = finite
+
+def convert(obj):
+    converter = CONVERTERS.get(type(obj))
+    if converter is None:
+        # Subclasses take the slow path
+        for _type in CONVERTERS:
+            if isinstance(obj, _type):
+                converter = CONVERTERS[_type]
+                break
+        else:
+            raise TypeError("Type %s not serializable: %s" % (str(type(obj)), obj))
+    return converter(obj)
+
+# Arrays of DB types come back as lists, nested values are prepared recursively
+NESTED = (list, tuple, dict)
+
+def prepare_rows(rows):
+    converters = PREPARE_CONVERTERS
+    prepared = []
+    for row in rows:
+        prepared_row = {}
+        for k, v in row.iteritems():
+            converter = converters.get(type(v))
+            if converter:
+                v = converter(v)
+            elif type(v) in NESTED:
+                v = prepare(v)
+            prepared_row[k] = v
+        prepared.append(prepared_row)
+    return prepared
+
+def prepare_tuples(rows):
+    converters = PREPARE_CONVERTERS
+    prepared = []
+    for row in rows:
+        prepared_row = []
+        for v in row:
+            converter = converters.get(type(v))
+            if converter:
+                v = converter(v)
+            elif type(v) in NESTED:
+                v = prepare(v)
+            prepared_row.append(v)
+        prepared.append(prepared_row)
+    return prepared
+
+def prepare(obj):
+    # ujson has no default hook so DB types are converted up front
+    if isinstance(obj, list) and obj and type(obj[0]) is dict:
+        return prepare_rows(obj)
+    elif isinstance(obj, list) and obj and type(obj[0]) is tuple:
+        return prepare_tuples(obj)
+    elif isinstance(obj, dict):
+        return {k : prepare(v) for k, v in obj.iteritems()}
+    elif isinstance(obj, (list, tuple)):
+        return [prepare(x) for x in obj]
+    converter = PREPARE_CONVERTERS.get(type(obj))
+    return converter(obj) if converter else obj
+
+def dumps_json(obj, sort_keys):
+    try:
+        return json.dumps(obj, default=convert, sort_keys=sort_keys, allow_nan=False)
+    except ValueError:
+        # Non finite floats, rare enough to take a second pass
+        return json.dumps(prepare(obj), default=convert, sort_keys=sort_keys)
+
+def dumps_simplejson(obj, sort_keys):
+    # Decimals as floats like the other encoders
+    return simplejson.dumps(obj, default=convert, sort_keys=sort_keys, use_decimal=False, ignore_nan=True)
+
+def dumps_ujson(obj, sort_keys):
+    return ujson.dumps(prepare(obj), sort_keys=sort_keys, escape_forward_slashes=False)
+
+ENCODERS = {
+    ENCODER_JSON       : dumps_json,
+    ENCODER_SIMPLEJSON : dumps_simplejson,
+    ENCODER_UJSON      : dumps_ujson
+}
+
+def get_available_encoders():
+    available = [ENCODER_JSON]
+    if simplejson:
+        available.append(ENCODER_SIMPLEJSON)
+    if ujson:
+        available.append(ENCODER_UJSON)
+    return available
+
+def get_encoder(name):
+    available = get_available_encoders()
+    if name == ENCODER_AUTO:
+        # Fastest C encoder installed, the stdlib otherwise
+        if ENCODER_UJSON in available:
+            name = ENCODER_UJSON
+        elif ENCODER_SIMPLEJSON in available and simplejson._import_c_make_encoder():
+            name = ENCODER_SIMPLEJSON
+        else:
+            name = ENCODER_JSON
+    if name not in available:
+        raise ValueError("JSON encoder %s is not available" % name)
+    return ENCODERS[name]
+
+ENCODER = get_encoder(settings.API_JSON_ENCODER)
+SORT_KEYS = settings.API_JSON_SORT_KEYS
+
+def dumps(obj):
+    return ENCODER(obj, SORT_KEYS)
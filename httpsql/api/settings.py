@@ -14,9 +14,42 @@ DB_HOST = os.environ.get("DB_HOST", "")
 DB_PORT = os.environ.get("DB_PORT", "")
 DB_CONNECTION_POOL_MIN = os.environ.get("DB_CONNECTION_POOL_MIN", "")
 DB_CONNECTION_POOL_MAX = os.environ.get("DB_CONNECTION_POOL_MAX", "")
+DB_CONNECTION_POOL_MAX_WAITERS = os.environ.get("DB_CONNECTION_POOL_MAX_WAITERS", 100)
+DB_CONNECTION_POOL_TIMEOUT_SECONDS = os.environ.get("DB_CONNECTION_POOL_TIMEOUT_SECONDS", 5)
+DB_CONNECTION_POOL_RETRY_AFTER_SECONDS = os.environ.get("DB_CONNECTION_POOL_RETRY_AFTER_SECONDS", 1)
 DB_CONNECTION_TIMEOUT_SECONDS = os.environ.get("DB_CONNECTION_TIMEOUT_SECONDS", 15)
-SCHEMA_MAX_WAIT_SECONDS = os.environ.get("SCHEMA_MAX_WAIT_SECONDS", 10)
+DB_APPLICATION_NAME = os.environ.get("DB_APPLICATION_NAME", "httpsql")
+DB_SEARCH_PATH = os.environ.get("DB_SEARCH_PATH", "")
+DB_STATEMENT_TIMEOUT_MS = os.environ.get("DB_STATEMENT_TIMEOUT_MS", "")
+DB_COOPERATIVE = os.environ.get("DB_COOPERATIVE", "") == "true"
+DB_COOPERATIVE_COPY_MAX_BYTES = os.environ.get("DB_COOPERATIVE_COPY_MAX_BYTES", 16777216)
+DB_STATEMENT_CACHE_SIZE = os.environ.get("DB_STATEMENT_CACHE_SIZE", 100)
+DB_REPLICA_HOSTS = os.environ.get("DB_REPLICA_HOSTS", "")
+DB_REPLICA_BALANCE = os.environ.get("DB_REPLICA_BALANCE", "round_robin")
+DB_REPLICA_MAX_LAG_SECONDS = os.environ.get("DB_REPLICA_MAX_LAG_SECONDS", 5)
+DB_REPLICA_LAG_CHECK_SECONDS = os.environ.get("DB_REPLICA_LAG_CHECK_SECONDS", 1)
+DB_SLOW_QUERY_MS = os.environ.get("DB_SLOW_QUERY_MS", 0)
+DB_SLOW_QUERY_FINGERPRINTS = os.environ.get("DB_SLOW_QUERY_FINGERPRINTS", 1000)
+DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE = os.environ.get("DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE", 0)
+DB_SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = os.environ.get("DB_SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS", 300)
+DB_LISTEN_POLL_SECONDS = os.environ.get("DB_LISTEN_POLL_SECONDS", 5)
+DB_LISTEN_RETRY_SECONDS = os.environ.get("DB_LISTEN_RETRY_SECONDS", 5)
+SCHEMA_POLL_SECONDS = os.environ.get("SCHEMA_POLL_SECONDS", 10)
+SCHEMA_INSTALL_EVENT_TRIGGER = os.environ.get("SCHEMA_INSTALL_EVENT_TRIGGER", "") == "true"
 API_DEFAULT_COLLECTION_ROW_LIMIT = os.environ.get("API_DEFAULT_COLLECTION_ROW_LIMIT", 25)
+API_QUERY_CACHE_SIZE = os.environ.get("API_QUERY_CACHE_SIZE", 1000)
+API_RESPONSE_CACHE_SIZE = os.environ.get("API_RESPONSE_CACHE_SIZE", 0)
+API_RESPONSE_CACHE_TTL_SECONDS = os.environ.get("API_RESPONSE_CACHE_TTL_SECONDS", 30)
+API_RESPONSE_CACHE_INSTALL_TRIGGERS = os.environ.get("API_RESPONSE_CACHE_INSTALL_TRIGGERS", "") == "true"
+API_COUNT_CACHE_SIZE = os.environ.get("API_COUNT_CACHE_SIZE", 1000)
+API_COUNT_CACHE_TTL_SECONDS = os.environ.get("API_COUNT_CACHE_TTL_SECONDS", 5)
+API_READ_YOUR_WRITES_SECONDS = os.environ.get("API_READ_YOUR_WRITES_SECONDS", 5)
+API_BATCH_MAX_OPERATIONS = os.environ.get("API_BATCH_MAX_OPERATIONS", 100)
+API_JSON_ENCODER = os.environ.get("API_JSON_ENCODER", "auto")
+API_JSON_SORT_KEYS = os.environ.get("API_JSON_SORT_KEYS", "true") == "true"
+API_STREAM_ITERSIZE = os.environ.get("API_STREAM_ITERSIZE", 2000)
+API_METRICS_DIR = os.environ.get("API_METRICS_DIR", "")
+API_METRICS_FLUSH_SECONDS = os.environ.get("API_METRICS_FLUSH_SECONDS", 1)
 API_LOG_LEVEL = os.environ.get("API_LOG_LEVEL", "INFO")
 BASIC_AUTH_USER = os.environ.get("BASIC_AUTH_USER", "")
 BASIC_AUTH_PASSWORD = os.environ.get("BASIC_AUTH_PASSWORD", "")
@@ -0,0 +1,97 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+import time
+import random
+import hashlib
+import threading
+import psycopg2
+import psycopg2.extensions
+import settings
+import log
+import lru
+
+# Statements slower than DB_SLOW_QUERY_MS, grouped by fingerprint i.e. the statement without its literals
+
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+WHITESPACE_RE = re.compile(r"\s+")
+
+ENTRIES = lru.LRUCache(settings.DB_SLOW_QUERY_FINGERPRINTS)
+LOCK = threading.Lock()
+
+def normalize(query):
+    # Generated statements pass values as parameters, only limits and offsets are inlined
+    return WHITESPACE_RE.sub(" ", LITERAL_RE.sub("?", query)).strip()
+
+def get_fingerprint(normalized):
+    return hashlib.sha1(normalized).hexdigest()[:16]
+
+def is_slow(duration):
+    threshold = int(settings.DB_SLOW_QUERY_MS)
+    return threshold > 0 and duration * 1000 >= threshold
+
+def should_explain(entry):
+    # Reruns the statement, so at most once per fingerprint and interval
+    if time.time() - entry["explained_at"] < float(settings.DB_SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS):
+        return False
+    return random.random() < float(settings.DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE)
+
+def explain(conn, query, params):
+    # Only outside of transactions, where a failing EXPLAIN can't abort anything
+    if not conn.autocommit or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        return None
+    try:
+        with conn.cursor() as c:
+            c.execute("explain (analyze, buffers, format json) %s" % query, params)
+            return c.fetchone()[0]
+    except psycopg2.Error, e:
+        log.error("Could not explain slow query: %s" % str(e))
+        return None
+
+def record(c, query, params, duration, succeeded=True, explain_safe=False):
+    normalized = normalize(query)
+    fingerprint = get_fingerprint(normalized)
+    rows = c.rowcount
+    log.info("Slow query %s %s after %dms with %d rows: %s" % (
+        fingerprint, "succeeded" if succeeded else "failed", duration * 1000, rows, normalized))
+    with LOCK:
+        entry = ENTRIES.get(fingerprint)
+        if entry is None:
+            entry = {
+                "fingerprint"  : fingerprint,
+                "query"        : normalized,
+                "calls"        : 0,
+                "total_ms"     : 0.0,
+                "max_ms"       : 0.0,
+                "rows"         : 0,
+                "last_seen"    : None,
+                "plan"         : None,
+                "explained_at" : 0
+            }
+            ENTRIES.put(fingerprint, entry)
+        entry["calls"] += 1
+        entry["total_ms"] += duration * 1000
+        entry["max_ms"] = max(entry["max_ms"], duration * 1000)
+        entry["rows"] += max(rows, 0)
+        entry["last_seen"] = time.time()
+        explaining = succeeded and explain_safe and should_explain(entry)
+        if explaining:
+            entry["explained_at"] = time.time()
+    if explaining:
+        plan = explain(c.connection, query, params)
+        if plan is not None:
+            entry["plan"] = plan
+
+def get_top(limit):
+    # Slowest fingerprints by total time first
+    with LOCK:
+        entries = [dict(x) for x in ENTRIES.values()]
+    entries.sort(key=lambda x: x["total_ms"], reverse=True)
+    for entry in entries:
+        entry["mean_ms"] = entry["total_ms"] / entry["calls"]
+        del entry["explained_at"]
+    return entries[:limit]
@@ -6,6 +6,7 @@
 
 from requests.auth import HTTPBasicAuth
 
+import collections
 import requests
 import os
 import json
@@ -31,9 +32,32 @@ class InternalError(Exception):
 HTTP_ENDPOINT = os.environ.get("HTTP_ENDPOINT", "")
 HTTP_USER = os.environ.get("HTTP_USER", "")
 HTTP_PASS = os.environ.get("HTTP_PASS", "")
+HTTP_COMPACT = os.environ.get("HTTP_COMPACT", "") == "true"
+HTTP_ETAG_CACHE_SIZE = int(os.environ.get("HTTP_ETAG_CACHE_SIZE", 100))
+
+COMPACT_CONTENT_TYPE = "application/vnd.httpsql.compact+json"
 
 session = requests.Session()        
 
+# Last ETag and decoded body per GET url for conditional requests, least recently used first
+etags = collections.OrderedDict()
+
+def get_etag(url):
+    entry = etags.pop(url, None)
+    if entry:
+        etags[url] = entry
+    return entry
+
+def put_etag(url, entry):
+    etags.pop(url, None)
+    etags[url] = entry
+    while len(etags) > HTTP_ETAG_CACHE_SIZE:
+        etags.popitem(last=False)
+
+def decode_compact(result):
+    columns = result["columns"]
+    return [dict(zip(columns, row)) for row in result["rows"]]
+
 def send_req(method, path, body=None):
     url = "%s/%s" % (HTTP_ENDPOINT, path)
     kwargs = {
@@ -43,6 +67,14 @@ def send_req(method, path, body=None):
 
     if HTTP_USER and HTTP_PASS:
         kwargs["auth"] = HTTPBasicAuth(HTTP_USER, HTTP_PASS)
+
+    kwargs["headers"] = {}
+    if method == "GET" and HTTP_COMPACT:
+        kwargs["headers"]["Accept"] = COMPACT_CONTENT_TYPE
+
+    cached = get_etag(url) if method == "GET" else None
+    if cached:
+        kwargs["headers"]["If-None-Match"] = cached[0]
     
     resp = session.request(
         method, 
@@ -50,7 +82,9 @@ def send_req(method, path, body=None):
         **kwargs
     )
 
-    if resp.status_code == 400:
+    if resp.status_code == 304 and cached:
+        return cached[1]
+    elif resp.status_code == 400:
         raise MalformedError(resp.text)
     elif resp.status_code == 404:
         raise NotFoundError(resp.text)
@@ -60,9 +94,15 @@ def send_req(method, path, body=None):
         raise InternalError(resp.text)
 
     try:
-        return resp.json()
+        result = resp.json()
+        if resp.headers.get("Content-Type", "").startswith(COMPACT_CONTENT_TYPE):
+            result = decode_compact(result)
     except Exception, e:
-        return resp.text
+        result = resp.text
+
+    if method == "GET" and "ETag" in resp.headers and HTTP_ETAG_CACHE_SIZE > 0:
+        put_etag(url, (resp.headers["ETag"], result))
+    return result
 
 class Function(object):
     def __init__(self):
@@ -90,7 +130,7 @@ class Function(object):
 
 class Collection(object):
     def __init__(self):
-        self.methods = ["filter", "get", "delete", "save", "count"]
+        self.methods = ["filter", "get", "delete", "save", "count", "update_many", "delete_many", "get_many"]
         self.definition = send_req("GET", "/collection/")
     
     def __getattr__(self, func):
@@ -108,6 +148,13 @@ class Collection(object):
     def get(self, pk):
         return send_req("GET", "/collection/%s/%s" % (self.name, pk))
 
+    def get_many(self, pks):
+        return send_req("GET", "/collection/%s/?%s__in=%s" % (
+            self.name,
+            self.definition[self.name]["primary_key"],
+            ",".join([str(x) for x in pks])
+        ))
+
     def filter(self, **kwargs):
         args = "&".join(["%s=%s" % (arg, kwargs[arg]) for arg in kwargs])
         return send_req("GET", "/collection/%s/%s" % (
@@ -131,5 +178,13 @@ class Collection(object):
     def update(self, pk, obj):
         return send_req("POST", "/collection/%s/%s/" % (self.name, pk), obj)
 
+    def update_many(self, obj, **kwargs):
+        args = "&".join(["%s=%s" % (arg, kwargs[arg]) for arg in kwargs])
+        return send_req("POST", "/collection/%s/?%s" % (self.name, args), obj)
+
+    def delete_many(self, **kwargs):
+        args = "&".join(["%s=%s" % (arg, kwargs[arg]) for arg in kwargs])
+        return send_req("DELETE", "/collection/%s/?%s" % (self.name, args))
+
 collection = Collection()
 function = Function()
\ No newline at end of file
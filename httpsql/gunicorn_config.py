@@ -0,0 +1,29 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Gunicorn settings for serving many concurrent queries per process:
+#   gunicorn -c python:httpsql.gunicorn_config httpsql.api:app
+# psycopg2 releases the GIL while it waits on Postgres, so each thread keeps a query in flight.
+# Read from the environment directly, importing httpsql.api here would connect in the master.
+
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:%s" % os.environ.get("PORT", 8000))
+# Each worker opens up to DB_CONNECTION_POOL_MAX connections, so more workers are opt in
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = "gthread"
+# One thread per pooled connection, more would only queue for the pool
+threads = int(os.environ.get("GUNICORN_THREADS", os.environ.get("DB_CONNECTION_POOL_MAX") or 8))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+
+def on_starting(server):
+    # Samples left by a previous run of the workers would be added to this one's
+    directory = os.environ.get("API_METRICS_DIR")
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.startswith("metrics_"):
+                os.remove(os.path.join(directory, name))
@@ -19,7 +19,8 @@ REQUIRES = [
   "python-mimeparse==1.5.2",
   "six==1.10.0",
   "requests==2.10.0",
-  "gunicorn==19.6.0"
+  "gunicorn==19.6.0",
+  "futures==3.0.5"
 ]
 
 cmdclass = {}
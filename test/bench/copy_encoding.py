@@ -0,0 +1,117 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Compares building a COPY buffer for bulk inserts with the compiled per-column encoders
+# against the previous CSV path, on supported_types style rows as decoded from a request body.
+# Usage: python test/bench/copy_encoding.py [rows] [repeat]
+
+import os
+import sys
+import json
+import timeit
+import cStringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "httpsql", "api"))
+
+import bulk
+
+TYPES = {
+    "a" : "smallint",
+    "b" : "integer",
+    "c" : "bigint",
+    "d" : "numeric",
+    "e" : "numeric",
+    "f" : "real",
+    "g" : "double precision",
+    "h" : "smallint",
+    "i" : "integer",
+    "j" : "bigint",
+    "k" : "money",
+    "l" : "bytea",
+    "m" : "boolean",
+    "n" : "character varying",
+    "o" : "character",
+    "p" : "text",
+    "q" : "timestamp without time zone",
+    "r" : "timestamp with time zone",
+    "s" : "date",
+    "t" : "time without time zone",
+    "u" : "time with time zone",
+    "v" : "jsonb",
+    "w" : "hstore"
+}
+
+def get_rows(count):
+    return json.loads(json.dumps([{
+        "a" : x % 32767,
+        "b" : x,
+        "c" : x * 1000000,
+        "d" : 1.5,
+        "e" : 12345.6789,
+        "f" : 1.0,
+        "g" : 1.0 / 3,
+        "h" : x % 32767,
+        "i" : x,
+        "j" : x,
+        "k" : 1.0,
+        "l" : "11001100",
+        "m" : True,
+        "n" : "a",
+        "o" : "a",
+        "p" : "Some longer text value for the text column",
+        "q" : "2004-10-19 10:23:54",
+        "r" : "2004-10-19 10:23:54",
+        "s" : "2004-10-19",
+        "t" : "10:23:54",
+        "u" : "10:23:54",
+        "v" : {"a" : [1, 2, 3, 4, 5, 6]},
+        "w" : {"x" : "123"}
+    } for x in range(count)]))
+
+def legacy(rows):
+    # The former query_gen.insert_table_rows_query, which dropped its delimiter, quote and line breaks
+    pg_copy_separator = "~"
+    pg_copy_csv_quote = "`"
+    pg_copy_lb = "\n"
+
+    def copy_escape(val):
+        return str(val).replace(pg_copy_separator, "").replace(pg_copy_csv_quote, "").replace(pg_copy_lb, "")
+
+    def normalize_value(val, ctype):
+        if ctype == "hstore" and isinstance(val, dict):
+            hstore_buff = []
+            for key in val:
+                hstore_buff.append('"%s"=>"%s"' % (key, copy_escape(val[key]).replace('"',"")))
+            return ",".join(hstore_buff)
+        elif ctype == "jsonb" and isinstance(val, dict) or isinstance(val, list):
+            return json.dumps(val)
+        else:
+            return copy_escape(val)
+
+    buff = cStringIO.StringIO()
+    for _dict in rows:
+        buff.write(pg_copy_separator.join([normalize_value(_dict[x], TYPES[x]) for x in _dict]) + "\n")
+    return buff
+
+def compiled(rows):
+    encode_row = bulk.compile_row_encoder(sorted(rows[0].keys()), TYPES)
+    buff = cStringIO.StringIO()
+    for row in rows:
+        buff.write(encode_row(row))
+    return buff
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rows = get_rows(count)
+
+    print "%-10s %12s %12s" % ("path", "best (ms)", "rows/s")
+    for name, build in (("legacy", legacy), ("compiled", compiled)):
+        best = min(timeit.repeat(lambda: build(rows), number=1, repeat=repeat))
+        print "%-10s %12.1f %12d" % (name, best * 1000, count / best)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Copyright (c) 2016 Till Mobile Inc.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Compares the JSON encoders on supported_types style rows, as returned by psycopg2,
+# in the default format (a dict per row) and the compact format (column header and arrays).
+# Usage: python test/bench/json_encoders.py [rows] [repeat]
+
+import os
+import sys
+import timeit
+import datetime
+
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "httpsql", "api"))
+
+import serializer
+
+def get_rows(count):
+    return [{
+        "a" : x % 32767,
+        "b" : x,
+        "c" : x * 1000000,
+        "d" : Decimal("1.5"),
+        "e" : Decimal("12345.6789"),
+        "f" : 1.0,
+        "g" : 1.0 / 3,
+        "h" : x % 32767,
+        "i" : x,
+        "j" : x,
+        "k" : "$1.00",
+        "l" : buffer("11001100"),
+        "m" : True,
+        "n" : "a",
+        "o" : "a",
+        "p" : "Some longer text value for the text column",
+        "q" : datetime.datetime(2004, 10, 19, 10, 23, 54),
+        "r" : datetime.datetime(2004, 10, 19, 10, 23, 54),
+        "s" : datetime.date(2004, 10, 19),
+        "t" : datetime.time(10, 23, 54),
+        "u" : datetime.time(10, 23, 54),
+        "v" : {"a" : [1, 2, 3, 4, 5, 6]},
+        "w" : {"x" : "123"}
+    } for x in range(count)]
+
+def get_compact(rows):
+    columns = sorted(rows[0].keys())
+    return {
+        "columns" : columns,
+        "types"   : [None for x in columns],
+        "rows"    : [tuple(row[x] for x in columns) for row in rows]
+    }
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    payloads = [("rows", get_rows(count))]
+    payloads.append(("compact", get_compact(payloads[0][1])))
+
+    print "%-12s %-8s %-10s %12s %12s %12s" % ("encoder", "format", "sort_keys", "best (ms)", "rows/s", "bytes")
+    for name in serializer.get_available_encoders():
+        encoder = serializer.ENCODERS[name]
+        for format, payload in payloads:
+            for sort_keys in (True, False):
+                best = min(timeit.repeat(lambda: encoder(payload, sort_keys), number=1, repeat=repeat))
+                size = len(encoder(payload, sort_keys))
+                print "%-12s %-8s %-10s %12.1f %12d %12d" % (name, format, sort_keys, best * 1000, count / best, size)
+
+if __name__ == "__main__":
+    main()
@@ -36,4 +36,27 @@ create table supported_types (
 create function items_by_size(t_size varchar)
 returns setof item as $$
   select * from item where attributes->'size' = t_size;
-$$ language 'sql';
\ No newline at end of file
+$$ language 'sql';
+
+create function slow_items(seconds float)
+returns setof item as $$
+  select pg_sleep(seconds);
+  select * from item;
+$$ language 'sql' stable;
+
+create function touch_items(seconds float)
+returns setof item as $$
+  select pg_sleep(seconds);
+  update item set description = description || '!';
+  select * from item;
+$$ language 'sql';
+
+create table array_types (
+  id serial primary key,
+  dates date[],
+  stamps timestamp[],
+  amounts numeric[]
+);
+
+insert into array_types (dates, stamps, amounts)
+values (array['2004-10-19'::date], array['2004-10-19 10:23:54'::timestamp], array[1.5, 0.1000]);
@@ -21,6 +21,14 @@ printf "export DB_PORT=5432\n" >> /opt/.env
 printf "export DB_CONNECTION_POOL_MIN=5\n" >> /opt/.env
 printf "export DB_CONNECTION_POOL_MAX=25\n" >> /opt/.env
 printf "export API_DEFAULT_COLLECTION_ROW_LIMIT=25\n" >> /opt/.env
+printf "export DB_REPLICA_HOSTS=127.0.0.1\n" >> /opt/.env
+printf "export API_METRICS_DIR=/tmp/httpsql_metrics\n" >> /opt/.env
+printf "export DB_SLOW_QUERY_MS=100\n" >> /opt/.env
+printf "export DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE=1\n" >> /opt/.env
+printf "export API_RESPONSE_CACHE_SIZE=1000\n" >> /opt/.env
+printf "export API_RESPONSE_CACHE_INSTALL_TRIGGERS=true\n" >> /opt/.env
+printf "export API_COUNT_CACHE_TTL_SECONDS=5\n" >> /opt/.env
+printf "export SCHEMA_INSTALL_EVENT_TRIGGER=true\n" >> /opt/.env
 
 # Setup DB as
 sudo service postgresql start
@@ -3,7 +3,7 @@
 cd /opt/
 source venv/bin/activate
 python setup.py install
-pip install gunicorn
+pip install gunicorn gevent
 
 # Set ENV
 . .env
@@ -11,13 +11,23 @@ pip install gunicorn
 # Start the DB
 sudo service postgresql start
 
-# Start the WSGI server
-nohup gunicorn httpsql.api:app --bind=127.0.0.1:8000 &
-
-# Load fixture data
+# Load fixture data first, the server installs its triggers on the tables at boot
 export PGPASSWORD=$DB_PASSWORD
 psql -h $DB_HOST -d $DB_DATABASE -U $DB_USER -p $DB_PORT -a -w -f /opt/test/fixtures/item.sql
 
+# Start the WSGI server
+nohup gunicorn -c python:httpsql.gunicorn_config httpsql.api:app --bind=127.0.0.1:8000 &
+sleep 2
+
 # Run tests
 cd /opt/test/
+python test.py || exit 1
+
+# Run them again on cooperative gevent workers
+pkill -f gunicorn
+sleep 2
+cd /opt/
+DB_COOPERATIVE=true nohup gunicorn -k gevent --worker-connections 200 httpsql.api:app --bind=127.0.0.1:8000 &
+sleep 2
+cd /opt/test/
 python test.py
\ No newline at end of file
@@ -4,7 +4,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import unittest, requests, os, psycopg2, os
+import unittest, requests, os, psycopg2, os, time, json, threading
 
 DATABASE = os.environ.get("DB_DATABASE", "")
 SCHEMA = os.environ.get("DB_SCHEMA", "")
@@ -13,6 +13,13 @@ PASSWORD = os.environ.get("DB_PASSWORD", "")
 HOST = os.environ.get("DB_HOST", "")
 PORT = os.environ.get("DB_PORT", "")
 ROW_LIMIT = os.environ.get("API_DEFAULT_COLLECTION_ROW_LIMIT", 25)
+REPLICA_HOSTS = os.environ.get("DB_REPLICA_HOSTS", "")
+SLOW_QUERY_MS = int(os.environ.get("DB_SLOW_QUERY_MS", 0))
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.environ.get("DB_SLOW_QUERY_EXPLAIN_SAMPLE_RATE", 0))
+RESPONSE_CACHE_SIZE = int(os.environ.get("API_RESPONSE_CACHE_SIZE", 0))
+RESPONSE_CACHE_INSTALL_TRIGGERS = os.environ.get("API_RESPONSE_CACHE_INSTALL_TRIGGERS", "") == "true"
+COOPERATIVE = os.environ.get("DB_COOPERATIVE", "") == "true"
+COOPERATIVE_COPY_MAX_BYTES = int(os.environ.get("DB_COOPERATIVE_COPY_MAX_BYTES", 16777216))
 
 class TestAPI(unittest.TestCase):
     def setUp(self):
@@ -101,6 +108,150 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(r.status_code, 200)
         self.assertTrue(len(r.content) > 0)
 
+    def test_etag(self):
+        """
+        Unchanged schema and records aren't sent again
+        """
+
+        for path in ("", "collection", "function"):
+            r = self.get(path)
+            self.assertEqual(r.status_code, 200, r.text)
+            etag = r.headers["ETag"]
+            r = requests.get("%s/%s/" % (self.API_URL, path), headers={"If-None-Match" : etag})
+            self.assertEqual(r.status_code, 304, r.text)
+            self.assertEqual(len(r.content), 0)
+
+        r = self.insert("collection/item", self.ITEM_DICT)
+        self.assertEqual(r.status_code, 204, r.text)
+        r = self.get("collection/item/1")
+        self.assertEqual(r.status_code, 200, r.text)
+        etag = r.headers["ETag"]
+        r = requests.get("%s/collection/item/1" % self.API_URL, headers={"If-None-Match" : etag})
+        self.assertEqual(r.status_code, 304, r.text)
+
+        r = self.update("collection/item", 1, {"name" : "Shoe Y"})
+        r = requests.get("%s/collection/item/1" % self.API_URL, headers={"If-None-Match" : etag})
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertNotEqual(r.headers["ETag"], etag)
+
+    def test_stats_get(self):
+        """
+        Retrieve the connection pool statistics
+        GET /stats
+        """
+
+        r = self.get("stats")
+        self.assertEqual(r.status_code, 200, r.text)
+        pool = r.json()["pool"]
+        self.assertTrue(pool["checkouts"] > 0)
+        self.assertTrue(pool["in_use"] + pool["connecting"] <= pool["max"])
+        self.assertEqual(pool["waiting"], 0)
+
+    def test_replica_reads(self):
+        """
+        Reads go to the replicas, clients that just wrote read from the primary
+        """
+
+        if not REPLICA_HOSTS:
+            self.skipTest("DB_REPLICA_HOSTS is not set")
+
+        def replica_checkouts():
+            replicas = self.get("stats").json()["replicas"]
+            self.assertEqual(len(replicas), len(REPLICA_HOSTS.split(",")))
+            return sum([x["checkouts"] for x in replicas])
+
+        # Replica reads don't fill the response cache, both go to the replica
+        before = replica_checkouts()
+        for i in range(2):
+            r = self.get("collection/item")
+            self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(replica_checkouts(), before + 2)
+
+        session = requests.Session()
+        r = session.put("%s/collection/item" % self.API_URL, json=self.ITEM_DICT)
+        self.assertEqual(r.status_code, 204, r.text)
+        self.assertTrue("httpsql_primary" in r.cookies)
+        r = session.get("%s/collection/item/1" % self.API_URL)
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.json()[0]["name"], self.ITEM_DICT["name"])
+        self.assertEqual(replica_checkouts(), before + 2)
+
+    def test_metrics_get(self):
+        """
+        Retrieve metrics in the Prometheus text format
+        GET /metrics
+        """
+
+        r = self.get("collection/item")
+        self.assertEqual(r.status_code, 200, r.text)
+
+        r = self.get("metrics")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertTrue(r.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        lines = r.text.splitlines()
+        self.assertTrue("# TYPE httpsql_request_duration_seconds histogram" in lines)
+        labels = 'route="/collection/{object_name}",collection="item",method="GET"'
+        self.assertTrue([x for x in lines if x.startswith("httpsql_request_duration_seconds_bucket{%s,le=\"+Inf\"}" % labels)])
+        self.assertTrue([x for x in lines if x.startswith("httpsql_requests_total{%s,status=\"200\"}" % labels)])
+        self.assertTrue([x for x in lines if x.startswith('httpsql_query_duration_seconds_count{operation="select"}')])
+        self.assertTrue([x for x in lines if x.startswith('httpsql_pool_connections{pool="primary",state="in_use"}')])
+
+        # Unknown collections aren't labeled
+        self.get("collection/bogus")
+        self.assertFalse('collection="bogus"' in self.get("metrics").text)
+
+    def test_slow_queries_get(self):
+        """
+        Retrieve the slowest query fingerprints of the worker process that served the request
+        GET /stats/slow_queries
+        """
+
+        if not SLOW_QUERY_MS:
+            self.skipTest("DB_SLOW_QUERY_MS is not set")
+
+        # Kept alive, so the same worker serves both requests
+        session = requests.Session()
+        seconds = SLOW_QUERY_MS * 2 / 1000.0
+        for x in range(2):
+            r = session.get("%s/function/slow_items" % self.API_URL, params={"seconds" : seconds})
+            self.assertEqual(r.status_code, 200, r.text)
+
+        r = session.get("%s/stats/slow_queries" % self.API_URL, params={"limit" : 100})
+        self.assertEqual(r.status_code, 200, r.text)
+        entries = [x for x in r.json() if "slow_items" in x["query"]]
+        self.assertEqual(len(entries), 1, r.text)
+        entry = entries[0]
+        # Literals are left out of the fingerprint
+        self.assertFalse(str(seconds) in entry["query"])
+        self.assertTrue(entry["calls"] >= 2)
+        self.assertTrue(entry["max_ms"] >= SLOW_QUERY_MS)
+        if SLOW_QUERY_EXPLAIN_SAMPLE_RATE >= 1:
+            self.assertEqual(entry["plan"][0]["Plan"]["Node Type"], "Limit")
+
+        # Volatile functions may write, so they are never run again to explain them
+        r = self.insert("collection/item", self.ITEM_DICT)
+        self.assertEqual(r.status_code, 204, r.text)
+        r = session.get("%s/function/touch_items" % self.API_URL, params={"seconds" : seconds})
+        self.assertEqual(r.status_code, 200, r.text)
+        with self.conn.cursor() as c:
+            c.execute("select description from item")
+            self.assertEqual(c.fetchone()[0], self.ITEM_DICT["description"] + "!")
+        r = session.get("%s/stats/slow_queries" % self.API_URL, params={"limit" : 100})
+        entries = [x for x in r.json() if "touch_items" in x["query"]]
+        self.assertEqual(len(entries), 1, r.text)
+        self.assertEqual(entries[0]["plan"], None)
+
+    def test_connection_setup(self):
+        """
+        Pooled connections are set up once with the configured session settings
+        """
+
+        r = self.get("collection/item")
+        self.assertEqual(r.status_code, 200, r.text)
+        with self.conn.cursor() as c:
+            c.execute("select count(*) from pg_stat_activity where application_name = 'httpsql'")
+            self.assertTrue(c.fetchone()[0] > 0)
+
     def test_collection_put(self):
         """
         Insert entities into the collection
@@ -134,6 +285,98 @@ class TestAPI(unittest.TestCase):
         rlist = r.json()
         self.assertTrue(len(rlist) == 4)
 
+    def test_collection_put_stream(self):
+        """
+        Insert entities from NDJSON and CSV bodies streamed into COPY
+        PUT /collection/<collection>/
+        """
+
+        def put(body, content_type):
+            return requests.put("%s/collection/item/" % self.API_URL, data=body, headers={"Content-Type" : content_type})
+
+        items = []
+        for x in range(3):
+            item = self.ITEM_DICT.copy()
+            item["name"] = "Shoe\t%d\n" % x
+            items.append(json.dumps(item))
+        r = put("\n".join(items) + "\n\n", "application/x-ndjson")
+        self.assertEqual(r.status_code, 204, r.text)
+
+        # Chunked bodies without a length
+        r = put((x + "\n" for x in items), "application/x-ndjson; charset=utf-8")
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = put('name,description\n"Shoe, Y","Multi\nline"\nShoe Z,\n', "text/csv")
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = self.get("collection/item", None, "?order_by=id")
+        rlist = r.json()
+        self.assertEqual([x["name"] for x in rlist], ["Shoe\t0\n", "Shoe\t1\n", "Shoe\t2\n"] * 2 + ["Shoe, Y", "Shoe Z"])
+        self.assert_item_dicts_equal(rlist[0], json.loads(items[0]))
+        self.assertEqual(rlist[6]["description"], "Multi\nline")
+        self.assertEqual(rlist[7]["description"], None)
+
+        # Bad rows roll back the whole body
+        r = put(items[0] + "\n{bogus\n", "application/x-ndjson")
+        self.assertEqual(r.status_code, 400, r.text)
+        r = put(items[0] + '\n{"name" : "x"}\n', "application/x-ndjson")
+        self.assertEqual(r.status_code, 400, r.text)
+        r = put("name,bogus\nShoe,1\n", "text/csv")
+        self.assertEqual(r.status_code, 400, r.text)
+        r = self.get("collection/item/count")
+        self.assertEqual(r.json()["count"], 8)
+
+        # Cooperative workers buffer bodies in memory, up to a limit
+        if COOPERATIVE:
+            body = (items[0] + "\n") * (COOPERATIVE_COPY_MAX_BYTES / len(items[0]) + 1)
+            r = put(body, "application/x-ndjson")
+            self.assertEqual(r.status_code, 413, r.text)
+            r = put((body[x:x + 65536] for x in range(0, len(body), 65536)), "application/x-ndjson")
+            self.assertEqual(r.status_code, 413, r.text)
+            row = json.dumps(dict(self.ITEM_DICT, id=1)) + "\n"
+            body = row * (COOPERATIVE_COPY_MAX_BYTES / len(row) + 1)
+            r = requests.put("%s/collection/item/?upsert=true" % self.API_URL, data=iter([body]), headers={"Content-Type" : "application/x-ndjson"})
+            self.assertEqual(r.status_code, 413, r.text)
+            r = self.get("collection/item/count")
+            self.assertEqual(r.json()["count"], 8)
+
+    def test_collection_put_upsert(self):
+        """
+        Insert or update entities by primary key in one statement
+        PUT /collection/<collection>/?upsert=true
+        """
+
+        def upsert(body, content_type="application/json"):
+            return requests.put("%s/collection/item/?upsert=true" % self.API_URL, data=body, headers={"Content-Type" : content_type})
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(3)])
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = upsert(json.dumps([{"id" : 1, "name" : "New 1"}, {"id" : 3, "name" : "New 3"}, {"id" : 10, "name" : "New 10"}]))
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.json(), {"inserted" : 1, "updated" : 2})
+
+        r = upsert('{"id" : 2, "name" : "New 2"}\n{"id" : 11, "name" : "New 11"}\n', "application/x-ndjson")
+        self.assertEqual(r.json(), {"inserted" : 1, "updated" : 1})
+
+        r = upsert("id,description\n1,Updated\n", "text/csv")
+        self.assertEqual(r.json(), {"inserted" : 0, "updated" : 1})
+
+        r = self.get("collection/item", None, "?order_by=id")
+        rlist = r.json()
+        self.assertEqual([x["id"] for x in rlist], [1, 2, 3, 10, 11])
+        self.assertEqual([x["name"] for x in rlist], ["New 1", "New 2", "New 3", "New 10", "New 11"])
+        self.assertEqual(rlist[0]["description"], "Updated")
+        self.assertEqual(rlist[1]["description"], self.ITEM_DICT["description"])
+
+        # The primary key is required and may only be passed once
+        r = upsert(json.dumps([{"name" : "No id"}]))
+        self.assertEqual(r.status_code, 400, r.text)
+        r = upsert(json.dumps([{"id" : 1, "name" : "A"}, {"id" : 1, "name" : "B"}]))
+        self.assertEqual(r.status_code, 400, r.text)
+        r = self.get("collection/item/count")
+        self.assertEqual(r.json()["count"], 5)
+
     def test_collection_post(self):
         """
         Update a single entity in the collection
@@ -161,6 +404,45 @@ class TestAPI(unittest.TestCase):
         ndict = nlist[0]
         self.assert_item_dicts_equal(rdict, ndict)
 
+    def test_collection_write_return(self):
+        """
+        Single row writes with Prefer: return=minimal|representation
+        PUT|POST|DELETE /collection/<collection>/<pk>
+        """
+
+        def write(method, path, body=None, preference=None):
+            headers = {"Prefer" : "return=%s" % preference} if preference else {}
+            return requests.request(method, "%s/%s" % (self.API_URL, path), json=body, headers=headers)
+
+        r = write("PUT", "collection/item", self.ITEM_DICT, "representation")
+        self.assertEqual(r.status_code, 201, r.text)
+        self.assertEqual(r.headers["Preference-Applied"], "return=representation")
+        rdict = r.json()[0]
+        self.assert_item_dicts_equal(rdict, self.ITEM_DICT)
+
+        # Updates return the row from RETURNING by default
+        rdict["name"] = "Shoe Y"
+        r = write("POST", "collection/item/%s" % rdict["id"], rdict)
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertFalse("Preference-Applied" in r.headers)
+        self.assert_item_dicts_equal(r.json()[0], rdict)
+
+        rdict["name"] = "Shoe Z"
+        r = write("POST", "collection/item/%s" % rdict["id"], rdict, "minimal")
+        self.assertEqual(r.status_code, 204, r.text)
+        self.assertEqual(r.headers["Preference-Applied"], "return=minimal")
+        self.assertEqual(self.get("collection/item/%s" % rdict["id"]).json()[0]["name"], "Shoe Z")
+
+        r = write("POST", "collection/item/1000", rdict, "minimal")
+        self.assertEqual(r.status_code, 404, r.text)
+
+        r = write("DELETE", "collection/item/%s" % rdict["id"], preference="representation")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assert_item_dicts_equal(r.json()[0], rdict)
+
+        r = write("DELETE", "collection/item/%s" % rdict["id"], preference="representation")
+        self.assertEqual(r.status_code, 404, r.text)
+
     def test_collection_get(self):
         """
         Retrieve one of more entities
@@ -257,6 +539,389 @@ class TestAPI(unittest.TestCase):
         r = self.get("collection/item", None, "?id__hmmm=0")
         self.assertTrue(r.status_code == 400)
 
+    def test_collection_get_cursor(self):
+        """
+        Page through entities by key instead of offset
+        GET /collection/<collection>?limit=<limit>&cursor=<cursor>&order_by=<order_by>
+        """
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(25)])
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = self.get("collection/item", None, "?limit=10&cursor=start")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual([x["id"] for x in r.json()], range(1, 11))
+
+        r = self.get("collection/item", None, "?limit=10&cursor=%s" % r.headers["X-Next-Cursor"])
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual([x["id"] for x in r.json()], range(11, 21))
+
+        r = self.get("collection/item", None, "?limit=10&cursor=%s" % r.headers["X-Next-Cursor"])
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual([x["id"] for x in r.json()], range(21, 26))
+        self.assertTrue("X-Next-Cursor" not in r.headers)
+
+        # Descending order
+        r = self.get("collection/item", None, "?limit=10&cursor=start&order_by=-id")
+        r = self.get("collection/item", None, "?limit=10&order_by=-id&cursor=%s" % r.headers["X-Next-Cursor"])
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual([x["id"] for x in r.json()], range(15, 5, -1))
+
+        # Cursor from another ordering
+        r = self.get("collection/item", None, "?limit=10&order_by=name&cursor=%s" % r.headers["X-Next-Cursor"])
+        self.assertEqual(r.status_code, 400, r.text)
+
+        # Cursor and offset
+        r = self.get("collection/item", None, "?cursor=start&offset=10")
+        self.assertEqual(r.status_code, 400, r.text)
+
+        def page_ids(table, order_by):
+            ids, cursor = [], "start"
+            while cursor:
+                r = self.get("collection/%s" % table, None, "?limit=2&order_by=%s&cursor=%s" % (order_by, cursor))
+                self.assertEqual(r.status_code, 200, r.text)
+                ids.extend([x["id" if table == "item" else "a"] for x in r.json()])
+                cursor = r.headers.get("X-Next-Cursor")
+            return ids
+
+        # Nulls sort last ascending and first descending
+        with self.conn.cursor() as c:
+            c.execute("delete from item")
+            c.execute("insert into item (id, name) values (1, 'a'), (2, null), (3, 'b'), (4, null), (5, 'a')")
+        self.assertEqual(page_ids("item", "name"), [1, 5, 3, 2, 4])
+        self.assertEqual(page_ids("item", "-name"), [4, 2, 3, 5, 1])
+
+        # Numerics keep their precision in the cursor
+        with self.conn.cursor() as c:
+            c.execute("insert into supported_types (a, e) values (1, 0.10000000000000000001), (2, 0.10000000000000000002), (3, 0.10000000000000000003)")
+        self.assertEqual(page_ids("supported_types", "e"), [1, 2, 3])
+
+    def test_collection_get_stream(self):
+        """
+        Stream entities from a server side cursor
+        GET /collection/<collection>?stream=true
+        """
+
+        r = self.get("collection/item", None, "?stream=true")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.json(), [])
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(50)])
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = self.get("collection/item", None, "?stream=true&limit=40&order_by=id")
+        self.assertEqual(r.status_code, 200, r.text)
+        rlist = r.json()
+        self.assertEqual([x["id"] for x in rlist], range(1, 41))
+        self.assert_item_dicts_equal(rlist[0], self.ITEM_DICT)
+
+        r = self.get("function/items_by_size", None, "?t_size=XL&stream=true")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(len(r.json()), int(ROW_LIMIT))
+
+        # Bogus field
+        r = self.get("collection/item", None, "?stream=true&position__gt=0")
+        self.assertEqual(r.status_code, 400, r.text)
+
+    def test_collection_get_compact(self):
+        """
+        Retrieve entities as column names and row arrays
+        GET /collection/<collection>?format=compact
+        """
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(5)])
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = self.get("collection/item", None, "?format=compact&order_by=id")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertTrue(r.headers["Content-Type"].startswith("application/vnd.httpsql.compact+json"))
+        result = r.json()
+        self.assertEqual(result["types"][result["columns"].index("id")], "integer")
+        rlist = [dict(zip(result["columns"], x)) for x in result["rows"]]
+        self.assertEqual([x["id"] for x in rlist], range(1, 6))
+        self.assert_item_dicts_equal(rlist[0], self.ITEM_DICT)
+
+        # Same rows whether asked for by parameter or Accept header, streamed or not
+        r = requests.get("%s/collection/item/?order_by=id" % self.API_URL,
+            headers={"Accept" : "application/vnd.httpsql.compact+json"})
+        self.assertEqual(r.json(), result)
+        r = self.get("collection/item", None, "?format=compact&order_by=id&stream=true")
+        self.assertEqual(r.json(), result)
+
+        r = self.get("collection/item", None, "?format=compact&stream=true&id__gt=100")
+        self.assertEqual(r.json()["rows"], [])
+
+        r = self.get("collection/item", None, "?format=compact&cursor=start&limit=3")
+        self.assertEqual(len(r.json()["rows"]), 3)
+        r = self.get("collection/item", None, "?format=compact&limit=3&cursor=%s" % r.headers["X-Next-Cursor"])
+        self.assertEqual([x[r.json()["columns"].index("id")] for x in r.json()["rows"]], [4, 5])
+
+        r = self.get("function/items_by_size", None, "?t_size=XL&format=compact")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(len(r.json()["rows"]), 5)
+
+        r = self.get("collection/item", None, "?format=xml")
+        self.assertEqual(r.status_code, 400, r.text)
+
+    def test_collection_get_total(self):
+        """
+        Retrieve a page of entities along with the total row count
+        GET /collection/<collection>?<query> with Prefer: count=exact
+        """
+
+        def get(qs):
+            return requests.get("%s/collection/item/%s" % (self.API_URL, qs), headers={"Prefer" : "count=exact"})
+
+        r = get("?limit=5")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.headers["Content-Range"], "*/0")
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(12)])
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = get("?limit=5&order_by=id")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.headers["Content-Range"], "0-4/12")
+        self.assertEqual(r.headers["Preference-Applied"], "count=exact")
+        self.assertEqual([x["id"] for x in r.json()], range(1, 6))
+        self.assertTrue("__httpsql_total" not in r.json()[0])
+
+        r = get("?limit=5&offset=10&order_by=id")
+        self.assertEqual(r.headers["Content-Range"], "10-11/12")
+        self.assertEqual([x["id"] for x in r.json()], [11, 12])
+
+        r = get("?limit=5&offset=20")
+        self.assertEqual(r.headers["Content-Range"], "*/12")
+
+        r = get("?limit=5&id__gt=4&format=compact")
+        self.assertEqual(r.headers["Content-Range"], "0-4/8")
+        self.assertEqual(len(r.json()["columns"]), len(r.json()["rows"][0]))
+        self.assertTrue("__httpsql_total" not in r.json()["columns"])
+
+        r = self.get("collection/item", None, "?limit=5")
+        self.assertTrue("Content-Range" not in r.headers)
+
+    def test_prepared_statement_ddl(self):
+        """
+        Prepared statements survive table changes behind the API's back
+        """
+
+        r = self.insert("collection/item", self.ITEM_DICT)
+        self.assertEqual(r.status_code, 204, r.text)
+        for x in range(1, 4):
+            r = self.get("collection/item", None, "?id__exact=1&limit=%d" % x)
+            self.assertEqual(r.status_code, 200, r.text)
+
+        with self.conn.cursor() as c:
+            c.execute("alter table item add column color varchar")
+        try:
+            for x in range(4, 7):
+                r = self.get("collection/item", None, "?id__exact=1&limit=%d" % x)
+                self.assertEqual(r.status_code, 200, r.text)
+                self.assertTrue("color" in r.json()[0])
+        finally:
+            with self.conn.cursor() as c:
+                c.execute("alter table item drop column color")
+
+    def test_collection_get_compiled_filters(self):
+        """
+        Queries sharing a filter signature only differ in their parameters
+        """
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(3)])
+        self.assertEqual(r.status_code, 204, r.text)
+        for x in range(1, 4):
+            r = self.get("collection/item", None, "?id__exact=%d" % x)
+            self.assertEqual([y["id"] for y in r.json()], [x])
+
+        r = self.get("collection/item", None, "?id__exact=id&name__contains=Shoe")
+        self.assertEqual(len(r.json()), 3)
+        r = self.get("collection/item", None, "?id__exact=id&name__contains=Boot")
+        self.assertEqual(len(r.json()), 0)
+
+    def test_response_cache(self):
+        """
+        Cached responses are dropped on writes through the API and through the DB
+        """
+
+        if not RESPONSE_CACHE_SIZE or not RESPONSE_CACHE_INSTALL_TRIGGERS:
+            self.skipTest("API_RESPONSE_CACHE_SIZE or API_RESPONSE_CACHE_INSTALL_TRIGGERS is not set")
+
+        # Replica reads aren't cached, so read from the primary
+        session = requests.Session()
+        session.cookies.set("httpsql_primary", "1")
+
+        def get(path, qs=""):
+            return session.get("%s/%s%s" % (self.API_URL, path, qs))
+
+        r = self.insert("collection/item", self.ITEM_DICT)
+        self.assertEqual(r.status_code, 204, r.text)
+        r = get("collection/item/1")
+        self.assertEqual(r.json()[0]["name"], self.ITEM_DICT["name"])
+
+        # Write through the API
+        r = self.update("collection/item", 1, {"name" : "Shoe Y"})
+        self.assertEqual(r.status_code, 200, r.text)
+        r = get("collection/item/1")
+        self.assertEqual(r.json()[0]["name"], "Shoe Y")
+        r = get("collection/item", "?name__exact=Shoe Y")
+        self.assertEqual(len(r.json()), 1)
+
+        # Write behind the API's back i.e. through the change triggers
+        with self.conn.cursor() as c:
+            c.execute("update item set name = 'Shoe Z' where id = 1")
+        time.sleep(0.5)
+        r = get("collection/item/1")
+        self.assertEqual(r.json()[0]["name"], "Shoe Z")
+        r = get("collection/item", "?name__exact=Shoe Y")
+        self.assertEqual(len(r.json()), 0)
+
+        # Tables created after boot get their trigger when the schema is reloaded
+        with self.conn.cursor() as c:
+            c.execute("create table late_item (id serial primary key, name varchar)")
+            c.execute("insert into late_item (name) values ('b')")
+        try:
+            for x in range(30):
+                with self.conn.cursor() as c:
+                    c.execute("select count(*) from pg_trigger where tgrelid = 'late_item'::regclass and tgname = 'httpsql_notify_change'")
+                    installed = c.fetchone()[0]
+                r = get("collection/late_item/1")
+                if installed and r.status_code == 200:
+                    break
+                time.sleep(1)
+            self.assertEqual(r.json()[0]["name"], "b")
+            with self.conn.cursor() as c:
+                c.execute("update late_item set name = 'c'")
+            time.sleep(0.5)
+            r = get("collection/late_item/1")
+            self.assertEqual(r.json()[0]["name"], "c")
+        finally:
+            with self.conn.cursor() as c:
+                c.execute("drop table late_item")
+
+    def test_schema_reload(self):
+        """
+        Schema changes are picked up without a restart
+        """
+
+        with self.conn.cursor() as c:
+            c.execute("create table reload_item (id serial primary key, name varchar)")
+        try:
+            for x in range(30):
+                r = self.get("collection/reload_item")
+                if r.status_code == 200:
+                    break
+                time.sleep(1)
+            self.assertEqual(r.status_code, 200, r.text)
+            r = self.get("collection")
+            self.assertTrue("reload_item" in r.json())
+        finally:
+            with self.conn.cursor() as c:
+                c.execute("drop table reload_item")
+
+    def test_batch(self):
+        """
+        Run several operations in one request on one connection
+        POST /batch
+        """
+
+        def batch(body):
+            return requests.post("%s/batch" % self.API_URL, json=body)
+
+        r = batch([
+            {"method" : "PUT", "path" : "/collection/item/", "body" : [self.ITEM_DICT, self.ITEM_DICT]},
+            {"method" : "GET", "path" : "/collection/item/1"},
+            {"method" : "POST", "path" : "/collection/item/2", "body" : {"name" : "Batched"}},
+            {"method" : "GET", "path" : "/collection/item/", "params" : {"name__exact" : "Batched"}},
+            {"method" : "GET", "path" : "/collection/item/count"},
+            {"method" : "GET", "path" : "/function/items_by_size", "params" : {"t_size" : "XL"}},
+            {"method" : "GET", "path" : "/collection/item/99"},
+            {"method" : "GET", "path" : "/collection/item/?format=compact", "headers" : {"Prefer" : "count=exact"}},
+        ])
+        self.assertEqual(r.status_code, 200, r.text)
+        results = r.json()
+        self.assertEqual([x["status"] for x in results], [204, 200, 200, 200, 200, 200, 404, 200])
+        self.assert_item_dicts_equal(results[1]["body"][0], self.ITEM_DICT)
+        self.assertEqual([x["id"] for x in results[3]["body"]], [2])
+        self.assertEqual(results[4]["body"]["count"], 2)
+        self.assertEqual(len(results[5]["body"]), 2)
+        self.assertEqual(results[7]["headers"]["content-range"], "0-1/2")
+        self.assertEqual(len(results[7]["body"]["rows"]), 2)
+
+        # A failed operation rolls back the transaction and ends the batch
+        r = batch({"transaction" : True, "operations" : [
+            {"method" : "DELETE", "path" : "/collection/item/1"},
+            {"method" : "GET", "path" : "/collection/item/count"},
+            {"method" : "PUT", "path" : "/collection/item/", "body" : [{"bogus" : 1}]},
+            {"method" : "DELETE", "path" : "/collection/item/2"}
+        ]})
+        self.assertEqual(r.status_code, 400, r.text)
+        self.assertEqual([x["status"] for x in r.json()], [204, 200, 400])
+        self.assertEqual(r.json()[1]["body"]["count"], 1)
+        r = self.get("collection/item/count")
+        self.assertEqual(r.json()["count"], 2)
+
+        # Upserts nest in the batch transaction and roll back with it
+        upsert = {"method" : "PUT", "path" : "/collection/item/", "params" : {"upsert" : "true"}}
+        r = batch({"transaction" : True, "operations" : [
+            dict(upsert, body=[{"id" : 3, "name" : "Upserted"}]),
+            dict(upsert, body=[{"id" : 3, "name" : "Again"}]),
+            {"method" : "GET", "path" : "/collection/item/3"},
+            {"method" : "PUT", "path" : "/collection/item/", "body" : [{"bogus" : 1}]}
+        ]})
+        self.assertEqual(r.status_code, 400, r.text)
+        self.assertEqual([x["status"] for x in r.json()], [200, 200, 200, 400])
+        self.assertEqual(r.json()[1]["body"], {"inserted" : 0, "updated" : 1})
+        self.assertEqual(r.json()[2]["body"][0]["name"], "Again")
+        r = self.get("collection/item/3")
+        self.assertEqual(r.status_code, 404, r.text)
+
+        r = batch({"transaction" : True, "operations" : [
+            {"method" : "DELETE", "path" : "/collection/item/1"},
+            {"method" : "DELETE", "path" : "/collection/item/2"}
+        ]})
+        self.assertEqual(r.status_code, 200, r.text)
+        r = self.get("collection/item/count")
+        self.assertEqual(r.json()["count"], 0)
+
+        r = batch([{"path" : "/collection/item/?stream=true"}, {"path" : "/batch", "method" : "POST"}, {"method" : "GET"}])
+        self.assertEqual([x["status"] for x in r.json()], [400, 400, 400])
+
+        # Bodies that aren't JSON come back as strings
+        r = batch([{"method" : "GET", "path" : "/metrics"}])
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertTrue(r.json()[0]["body"].startswith("# HELP"), r.text)
+
+    def test_collection_get_in(self):
+        """
+        Retrieve entities matching any or none of a list of values
+        GET /collection/<collection>?<field>__in=<value>,<value>
+        """
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(40)])
+        self.assertEqual(r.status_code, 204, r.text)
+
+        # More keys than the default row limit
+        pks = range(2, 40, 1)
+        r = self.get("collection/item", None, "?order_by=id&id__in=%s" % ",".join([str(x) for x in pks]))
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual([x["id"] for x in r.json()], pks)
+
+        r = self.get("collection/item", None, "?id__in=7")
+        self.assertEqual([x["id"] for x in r.json()], [7])
+
+        r = self.get("collection/item", None, "?limit=100&id__not_in=%s" % ",".join([str(x) for x in pks]))
+        self.assertEqual(sorted([x["id"] for x in r.json()]), [1, 40])
+
+        r = self.get("collection/item", None, "?attributes.size__in=XL,L&name__in=Shoe X&limit=5")
+        self.assertEqual(len(r.json()), 5)
+
+        r = self.get("collection/item", None, "?id__in=a,b")
+        self.assertEqual(r.status_code, 400, r.text)
+
+        r = self.get("collection/item/count", None, "?id__in=1,2,3")
+        self.assertEqual(r.json()["count"], 3)
+
     def test_count_get(self):
         """
         Reteive the row count for the passed query
@@ -272,6 +937,91 @@ class TestAPI(unittest.TestCase):
         rdict = r.json()
         self.assertTrue(rdict["count"] == 1)
 
+    def test_count_get_modes(self):
+        """
+        Retrieve exact, planned and estimated row counts
+        GET /collection/<collection>/count?<query>&count=<mode>
+        """
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(20)])
+        self.assertEqual(r.status_code, 204, r.text)
+        with self.conn.cursor() as c:
+            c.execute("analyze item")
+
+        r = self.get("collection/item/count", None, "?count=estimated")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.headers["X-Count-Mode"], "estimated")
+        self.assertEqual(r.json()["count"], 20)
+
+        # Filtered counts fall back to the planner's estimate
+        r = self.get("collection/item/count", None, "?count=estimated&id__gt=10")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.headers["X-Count-Mode"], "planned")
+        self.assertTrue(r.json()["count"] > 0)
+
+        r = self.get("collection/item/count", None, "?count=planned")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.json()["count"], 20)
+
+        # Writes through the API drop cached exact counts
+        r = self.get("collection/item/count", None, "?id__gt=10")
+        self.assertEqual(r.headers["X-Count-Mode"], "exact")
+        self.assertEqual(r.json()["count"], 10)
+        r = self.delete("collection/item/20")
+        self.assertEqual(r.status_code, 204, r.text)
+        r = self.get("collection/item/count", None, "?id__gt=10")
+        self.assertEqual(r.json()["count"], 9)
+
+        r = self.get("collection/item/count", None, "?count=roughly")
+        self.assertEqual(r.status_code, 400, r.text)
+
+    def test_collection_write_by_query(self):
+        """
+        Update and delete the entities matching a query
+        POST /collection/<collection>/?<query>
+        DELETE /collection/<collection>/?<query>
+        """
+
+        r = self.insert("collection/item", [self.ITEM_DICT for x in range(10)])
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = requests.post("%s/collection/item/?id__gt=6" % self.API_URL, json={"name" : "Updated", "description" : "Bulk"})
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.json(), {"count" : 4})
+
+        r = requests.post("%s/collection/item/?name__exact=Updated&return_pks=true" % self.API_URL, json={"description" : "Again"})
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(sorted(r.json()["pks"]), [7, 8, 9, 10])
+
+        r = self.get("collection/item", None, "?description__exact=Again&order_by=id")
+        self.assertEqual([x["id"] for x in r.json()], [7, 8, 9, 10])
+        self.assertEqual(r.json()[0]["name"], "Updated")
+
+        r = requests.delete("%s/collection/item/?id__lte=3&return_pks=true" % self.API_URL)
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual(r.json()["count"], 3)
+        self.assertEqual(sorted(r.json()["pks"]), [1, 2, 3])
+
+        r = self.get("collection/item/count")
+        self.assertEqual(r.json()["count"], 7)
+
+        # A filter is required, fields must exist
+        r = requests.delete("%s/collection/item/" % self.API_URL)
+        self.assertEqual(r.status_code, 400, r.text)
+        r = requests.post("%s/collection/item/" % self.API_URL, json={"name" : "All"})
+        self.assertEqual(r.status_code, 400, r.text)
+        r = requests.post("%s/collection/item/?id__gt=0" % self.API_URL, json={"bogus" : "x"})
+        self.assertEqual(r.status_code, 400, r.text)
+
+        # Filters that can't apply fail instead of widening the write
+        for qs in ("name.x__exact=1", "name__contains=description", "name__x__exact=1"):
+            r = requests.delete("%s/collection/item/?id__gt=0&%s" % (self.API_URL, qs))
+            self.assertEqual(r.status_code, 400, r.text)
+        r = requests.post("%s/collection/item/?id__gt=0&name.x__exact=1" % self.API_URL, json={"name" : "All"})
+        self.assertEqual(r.status_code, 400, r.text)
+        r = self.get("collection/item/count")
+        self.assertEqual(r.json()["count"], 7)
+
     def test_collection_delete(self):
         """
         Delete a collection entity
@@ -306,6 +1056,11 @@ class TestAPI(unittest.TestCase):
         rdict = rlist[0]
         self.assert_item_dicts_equal(rdict, self.ITEM_DICT)
 
+        r = self.insert("collection/item", self.ITEM_DICT)
+        r = self.get("function/items_by_size", None, "?t_size=XL&order_by=-id")
+        self.assertEqual(r.status_code, 200, r.text)
+        self.assertEqual([x["id"] for x in r.json()], [2, 1])
+
         # Bogus function
         r = self.get("function/itemby_size", None, "?t_size=XL")
         self.assertEqual(r.status_code, 404)
@@ -318,6 +1073,46 @@ class TestAPI(unittest.TestCase):
         r = self.get("function/items_by_size")
         self.assertEqual(r.status_code, 400)
 
+    def test_collection_get_arrays(self):
+        """
+        Arrays of dates, timestamps and numerics are encoded like single values
+        GET /api/collection/<collection>
+        """
+
+        for qs in ("", "?format=compact"):
+            r = self.get("collection/array_types", None, qs)
+            self.assertEqual(r.status_code, 200, r.text)
+            row = r.json()[0] if not qs else dict(zip(r.json()["columns"], r.json()["rows"][0]))
+            self.assertEqual(row["dates"], ["2004-10-19"])
+            self.assertEqual(row["stamps"], ["2004-10-19T10:23:54"])
+            self.assertEqual(row["amounts"], [1.5, 0.1])
+            # Floats with every encoder, not exact decimals
+            self.assertFalse("0.1000" in r.text, r.text)
+
+    def test_function_get_concurrent(self):
+        """
+        Slow queries overlap instead of queueing behind each other
+        GET /api/function/slow_items?seconds=<seconds>
+        """
+
+        count, seconds = 20, 0.5
+        statuses = []
+
+        def call():
+            r = self.get("function/slow_items", None, "?seconds=%s" % seconds)
+            statuses.append(r.status_code)
+
+        threads = [threading.Thread(target=call) for x in range(count)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        self.assertEqual(statuses, [200] * count)
+        self.assertTrue(elapsed < count * seconds / 4, "%d queries of %ss took %.2fs" % (count, seconds, elapsed))
+
     def test_row_limit(self):
         """
         Make sure the default row limit is respected
@@ -342,6 +1137,15 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(len(rlist), 1)
         rdict = rlist[0]
 
+        # Non finite floats aren't JSON, they come back as null
+        with self.conn.cursor() as c:
+            c.execute("insert into supported_types (a, e, f, g) values (2, 'NaN', '-Infinity', 'NaN')")
+        for qs in ("?a__exact=2", "?a__exact=2&format=compact"):
+            r = self.get("collection/supported_types", None, qs)
+            self.assertEqual(r.status_code, 200, r.text)
+            rdict = r.json()[0] if "compact" not in qs else dict(zip(r.json()["columns"], r.json()["rows"][0]))
+            self.assertEqual([rdict["e"], rdict["f"], rdict["g"]], [None, None, None])
+
     def test_types_multiple_inserts(self):
         """
         Ensure multi-insert i.e. COPY works with all supported types.
@@ -356,6 +1160,34 @@ class TestAPI(unittest.TestCase):
         rlist = r.json()
         self.assertEqual(len(rlist), 2)
 
+    def test_multiple_inserts_escaping(self):
+        """
+        Ensure multi-insert i.e. COPY keeps delimiters, quotes, line breaks and nulls intact.
+        """
+
+        names = [u"a~b`c", u"tab\there", u"line\nbreak\r\n", u"back\\slash \\N", u"\"quoted\" 'x'", u"\u00fcml\u00e4ut"]
+        items = []
+        for name in names:
+            item = self.ITEM_DICT.copy()
+            item["name"] = name
+            item["description"] = None
+            item["attributes"] = {"size" : name, "sku" : "1,2=>3", "weight" : 0}
+            items.append(item)
+        r = self.insert("collection/item", items)
+        self.assertEqual(r.status_code, 204, r.text)
+
+        r = self.get("collection/item", None, "?order_by=id")
+        self.assertEqual(r.status_code, 200, r.text)
+        rlist = r.json()
+        self.assertEqual([x["name"] for x in rlist], names)
+        self.assertEqual([x["attributes"]["size"] for x in rlist], names)
+        self.assertEqual(rlist[0]["attributes"]["sku"], "1,2=>3")
+        self.assertEqual(rlist[0]["description"], None)
+
+        items[1]["bogus"] = 1
+        r = self.insert("collection/item", items)
+        self.assertEqual(r.status_code, 400, r.text)
+
     def test_types_update(self):
         """
         Ensure we can update supported types.